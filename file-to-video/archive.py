@@ -0,0 +1,120 @@
+"""Directory archives: many files packed into a single chunk stream.
+
+The packed stream starts with an index, a compact JSON list of
+[name, offset, size, sha256] entries whose offsets count from the end of
+the index, followed by the contents of the files back to back in index
+order. The index thus lands in the leading data frames of the video, and
+the metadata frame records its size as IndexSize, so a single file can be
+found and extracted by decoding only the index and that file's chunks.
+"""
+
+import bisect
+import hashlib
+import json
+import os
+
+
+def list_files(root):
+    """Paths of the regular files under root, relative to it with "/"
+    separators, in a stable order."""
+    names = []
+    for folder, dirs, files in os.walk(root):
+        dirs.sort()
+        for file in sorted(files):
+            path = os.path.join(folder, file)
+            if os.path.isfile(path):
+                names.append(os.path.relpath(path, root).replace(os.sep, "/"))
+    return names
+
+
+def file_digest(path):
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def pack_index(entries):
+    return json.dumps(entries, separators=(",", ":")).encode("utf-8")
+
+
+def unpack_index(data):
+    return json.loads(bytes(data).decode("utf-8"))
+
+
+class Archive:
+    """The packed stream of the files under a directory.
+
+    read() serves any span of the stream straight from the files, so the
+    stream itself is never written out.
+    """
+
+    def __init__(self, root):
+        self.root = root
+        self.entries = []
+        offset = 0
+        for name in list_files(root):
+            path = os.path.join(root, name)
+            size = os.path.getsize(path)
+            self.entries.append([name, offset, size, file_digest(path)])
+            offset += size
+        self.index = pack_index(self.entries)
+        self.starts = [len(self.index) + entry[1] for entry in self.entries]
+        self.size = len(self.index) + offset
+
+    def read(self, offset, length):
+        """length bytes of the packed stream starting at offset."""
+        end = offset + length
+        data = bytearray(self.index[offset:end])
+        i = max(0, bisect.bisect_right(self.starts, offset) - 1)
+        while i < len(self.entries) and self.starts[i] < end:
+            name, _, size, _ = self.entries[i]
+            start = self.starts[i]
+            low, high = max(offset, start), min(end, start + size)
+            if low < high:
+                with open(os.path.join(self.root, name), "rb") as f:
+                    f.seek(low - start)
+                    data += f.read(high - low)
+            i += 1
+        return data
+
+
+def member_path(root, name):
+    """Where an archive member is restored under root; refuses names that
+    would land outside it."""
+    parts = name.split("/")
+    if name.startswith("/") or ".." in parts or "" in parts:
+        raise ValueError(f"unsafe archive member name: {name!r}")
+    return os.path.join(root, *parts)
+
+
+def find_member(entries, name):
+    for entry in entries:
+        if entry[0] == name:
+            return entry
+    raise KeyError(f"{name!r} is not in the archive")
+
+
+def write_member(root, entry, data):
+    """Restore one member from its data; returns whether its digest matched."""
+    path = member_path(root, entry[0])
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "wb") as f:
+        f.write(data)
+    return hashlib.sha256(data).hexdigest() == entry[3]
+
+
+def unpack_archive(packed, root, index_size):
+    """Split a decoded packed stream into its files under root.
+
+    Returns the names of the members whose digest did not match.
+    """
+    damaged = []
+    with open(packed, "rb") as f:
+        entries = unpack_index(f.read(index_size))
+        for entry in entries:
+            f.seek(index_size + entry[1])
+            if not write_member(root, entry, f.read(entry[2])):
+                damaged.append(entry[0])
+    return damaged
@@ -0,0 +1,82 @@
+"""Benchmark frame generation + H.264 encoding: RGB/PIL path vs luma path.
+
+The "rgb" path is the original one: grid -> 3-channel stack -> PIL NEAREST
+resize -> rgb24 VideoFrame, converted to yuv420p by libswscale. The "luma"
+path rasterizes straight into a reused yuv420p buffer. Each path runs in
+its own subprocess so the reported peak RSS is not shared between them.
+
+    python bench_frames.py [--frames N] [--grid-size N]
+"""
+
+import argparse
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+
+import av
+
+from common import *
+from v2 import encode_to_image, encode_to_luma, new_yuv420_frame
+
+width_height = 1080
+
+
+def run(mode, frames, grid_size):
+    payloads = [os.urandom(grid_size * grid_size // 8) for _ in range(8)]
+    buffer = new_yuv420_frame(width_height, width_height)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        container = av.open(os.path.join(tmp, "bench.mp4"), mode="w")
+        stream = container.add_stream("h264", rate=20)
+        stream.width = width_height
+        stream.height = width_height
+        stream.pix_fmt = "yuv420p"
+        stream.options = {"crf": "40"}
+
+        start = time.perf_counter()
+        for i in range(frames):
+            data = payloads[i % len(payloads)]
+            if mode == "rgb":
+                image = encode_to_image(data, grid_size, width_height)
+                frame = av.VideoFrame.from_ndarray(image, format="rgb24")
+            else:
+                encode_to_luma(data, grid_size, width_height, out=buffer)
+                frame = av.VideoFrame.from_ndarray(buffer, format="yuv420p")
+            for packet in stream.encode(frame):
+                container.mux(packet)
+        for packet in stream.encode():
+            container.mux(packet)
+        container.close()
+        elapsed = time.perf_counter() - start
+
+    peak_kb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    print(f"{mode} {frames / elapsed:.1f} {peak_kb / 1024:.1f}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--frames", type=int, default=100)
+    parser.add_argument("--grid-size", type=int, default=global_gridSize)
+    parser.add_argument("--mode", choices=("rgb", "luma"), help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.mode:
+        run(args.mode, args.frames, args.grid_size)
+        return
+
+    print(f"{args.frames} frames, grid {args.grid_size}, {width_height}p")
+    print(f"{'path':8}{'frames/sec':>12}{'peak RSS MB':>14}")
+    for mode in ("rgb", "luma"):
+        out = subprocess.run(
+            [sys.executable, __file__, "--mode", mode,
+             "--frames", str(args.frames), "--grid-size", str(args.grid_size)],
+            check=True, capture_output=True, text=True,
+        ).stdout.split()
+        print(f"{out[0]:8}{float(out[1]):12.1f}{float(out[2]):14.1f}")
+
+
+if __name__ == "__main__":
+    main()
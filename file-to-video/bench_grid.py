@@ -0,0 +1,90 @@
+"""Micro-benchmark for the bit-grid rasterizer and sampler in v2.py.
+
+Compares the original per-cell getBit/setBit loops against the NumPy
+bit-plane codec and prints frames/sec for both.
+
+    python bench_grid.py [--grid-size N] [--frames N]
+"""
+
+import argparse
+import os
+import time
+
+import numpy as np
+
+from common import *
+from v2 import create_custom_code, decode_from_image, getBit, setBit
+
+width_height = 1080
+
+
+def create_custom_code_loop(data, grid_size=256):
+    """Reference rasterizer: the original Python double loop."""
+    grid = np.zeros((grid_size, grid_size), dtype=np.uint8)
+    bit_length = len(data) * 8
+    bit_index = 0
+    for i in range(grid_size):
+        for j in range(grid_size):
+            if bit_index >= bit_length:
+                return grid
+            if getBit(data, bit_index):
+                grid[i, j] = 255
+            bit_index += 1
+    return grid
+
+
+def sample_grid_loop(grid, grid_size=256):
+    """Reference sampler: the original Python double loop."""
+    data = bytearray(grid_size * grid_size // 8)
+    bit_index = 0
+    for i in range(grid_size):
+        for j in range(grid_size):
+            if grid[i, j] > 128 and bit_index // 8 < len(data):
+                setBit(data, bit_index)
+            bit_index += 1
+    return data
+
+
+def sample_grid(grid, grid_size=256):
+    """Bit extraction half of decode_from_image, without sampling cells."""
+    bits = grid.reshape(-1) > 128
+    return bytearray(np.packbits(bits, bitorder="little")[: bits.size // 8])
+
+
+def bench(fn, args, frames):
+    start = time.perf_counter()
+    for _ in range(frames):
+        fn(*args)
+    return frames / (time.perf_counter() - start)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--grid-size", type=int, default=global_gridSize)
+    parser.add_argument("--frames", type=int, default=20)
+    args = parser.parse_args()
+
+    grid_size = args.grid_size
+    data = os.urandom(grid_size * grid_size // 8)
+
+    grid = create_custom_code(data, grid_size)
+    assert np.array_equal(grid, create_custom_code_loop(data, grid_size))
+    image = np.stack([grid] * 3, axis=-1)
+    decoded = decode_from_image(image, grid_size)
+    assert decoded == sample_grid_loop(grid, grid_size) == bytearray(data)
+
+    print(f"grid {grid_size}x{grid_size}, {len(data)} bytes/frame")
+    print(f"{'':12}{'loop fps':>12}{'numpy fps':>12}{'speedup':>10}")
+
+    rows = [
+        ("rasterize", create_custom_code_loop, create_custom_code, (data, grid_size)),
+        ("sample", sample_grid_loop, sample_grid, (grid, grid_size)),
+    ]
+    for name, before, after, fn_args in rows:
+        old = bench(before, fn_args, max(1, args.frames // 10))
+        new = bench(after, fn_args, args.frames * 10)
+        print(f"{name:12}{old:12.1f}{new:12.1f}{new / old:9.0f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,118 @@
+"""Bit error rate of each cell modulation against H.264 crf.
+
+Encodes random full frames with every modulation in v2.MODULATIONS at each
+crf, decodes them back and counts the bits that flipped, so the payload
+gain of a mode can be weighed against the RS parity it needs. Further
+tables give the rate of damaged bytes, which is what RS decoding sees and
+what --macroblock changes, and the size of the video per byte of payload.
+
+    python bench_modulation.py [--frames N] [--crf N [N ...]] [--grid-size N]
+                               [--macroblock]
+"""
+
+import argparse
+import os
+import tempfile
+
+import av
+import numpy as np
+
+from common import *
+from encode import macroblock_cells
+from v2 import (
+    MODULATIONS,
+    decode_with_margins,
+    encode_to_luma,
+    frame_capacity,
+    new_yuv420_frame,
+)
+
+width_height = 1080
+
+
+def bit_errors(mode, crf, frames, grid_size, calibrated, block):
+    """(flipped bits, damaged bytes, total bytes, video bytes) over frames
+    random frames."""
+    capacity = frame_capacity(grid_size, calibrated, mode)
+    payloads = [os.urandom(capacity) for _ in range(frames)]
+    buffer = new_yuv420_frame(width_height, width_height)
+    fmt = "yuv420p" if MODULATIONS[mode][1] else "gray"
+
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "bench.mp4")
+        container = av.open(path, mode="w")
+        stream = container.add_stream("h264", rate=20)
+        stream.width = width_height
+        stream.height = width_height
+        stream.pix_fmt = "yuv420p"
+        stream.options = {"crf": str(crf)}
+        for data in payloads:
+            encode_to_luma(
+                data, grid_size, width_height, buffer, calibrated, mode, block
+            )
+            frame = av.VideoFrame.from_ndarray(buffer, format="yuv420p")
+            for packet in stream.encode(frame):
+                container.mux(packet)
+        for packet in stream.encode():
+            container.mux(packet)
+        container.close()
+        size = os.path.getsize(path)
+
+        flipped = damaged = 0
+        with av.open(path) as container:
+            decoded = container.decode(container.streams.video[0])
+            for data, frame in zip(payloads, decoded):
+                image = frame.to_ndarray(format=fmt)
+                out, _ = decode_with_margins(
+                    image, grid_size, calibrated, mode, block
+                )
+                diff = np.frombuffer(data, np.uint8) ^ np.frombuffer(out, np.uint8)
+                flipped += int(np.unpackbits(diff).sum())
+                damaged += int(np.count_nonzero(diff))
+    return flipped, damaged, capacity * frames, size
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--frames", type=int, default=20)
+    parser.add_argument("--crf", type=int, nargs="+", default=[20, 30, 35, 40])
+    parser.add_argument("--grid-size", type=int, default=global_gridSize)
+    parser.add_argument("--no-calibration", dest="calibrated", action="store_false")
+    parser.add_argument("--macroblock", action="store_true")
+    args = parser.parse_args()
+    block = 1
+    if args.macroblock:
+        block = macroblock_cells(width_height, args.grid_size)
+
+    header = f"{'modulation':14}{'bytes/frame':>12}" + "".join(
+        f"{'crf ' + str(crf):>12}" for crf in args.crf
+    )
+    errors = []
+    bytes_ = []
+    sizes = []
+    for mode in MODULATIONS:
+        capacity = frame_capacity(args.grid_size, args.calibrated, mode)
+        ber = f"{mode:14}{capacity:12}"
+        byte_rate = ratio = ber
+        for crf in args.crf:
+            flipped, damaged, total, size = bit_errors(
+                mode, crf, args.frames, args.grid_size, args.calibrated, block
+            )
+            ber += f"{flipped / (total * 8):12.2e}"
+            byte_rate += f"{damaged / total:12.2e}"
+            ratio += f"{size / total:12.3f}"
+        errors.append(ber)
+        bytes_.append(byte_rate)
+        sizes.append(ratio)
+
+    print(f"{args.frames} frames, grid {args.grid_size}, {width_height}p")
+    print("\nbit error rate")
+    print(header, *errors, sep="\n")
+    print("\nbyte error rate")
+    print(header, *bytes_, sep="\n")
+    print("\nvideo bytes per payload byte")
+    print(header, *sizes, sep="\n")
+
+
+if __name__ == "__main__":
+    main()
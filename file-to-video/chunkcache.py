@@ -0,0 +1,41 @@
+"""Byte-budgeted LRU cache of RS-encoded chunks keyed by content digest.
+
+Disk images and dumps repeat the same chunks, most often all zeros, many
+times over. Each worker keeps the encodings of the chunks it saw last, so a
+repeat skips Reed-Solomon encoding, by far the most expensive step of
+turning a chunk into a frame.
+"""
+
+import hashlib
+from collections import OrderedDict
+
+default_cache_bytes = 32 << 20
+
+
+def chunk_digest(data):
+    return hashlib.blake2b(data, digest_size=16).digest()
+
+
+class ChunkCache:
+    """Maps digests to encodings, evicting the least recently used ones
+    once their total size exceeds budget bytes."""
+
+    def __init__(self, budget):
+        self.budget = budget
+        self.size = 0
+        self.entries = OrderedDict()
+
+    def get(self, key):
+        value = self.entries.get(key)
+        if value is not None:
+            self.entries.move_to_end(key)
+        return value
+
+    def put(self, key, value):
+        if key in self.entries or len(value) > self.budget:
+            return
+        self.entries[key] = value
+        self.size += len(value)
+        while self.size > self.budget:
+            _, old = self.entries.popitem(last=False)
+            self.size -= len(old)
@@ -3,3 +3,5 @@
 global_reedN = 255
 global_reedEC = 10
 global_gridSize = 270
+# Frame side the default grid is sized for, global_gridSize cells across it.
+default_resolution = 1080
@@ -0,0 +1,99 @@
+"""Block compression of the chunk stream before Reed-Solomon encoding.
+
+The stream is cut into blocks of a fixed size that are compressed
+independently, so workers can compress them in parallel and a byte range
+can be decompressed without touching the rest. The compressed stream
+starts with a table of the compressed length of every block (4 bytes each,
+big-endian), followed by the blocks back to back. A block that does not
+shrink is stored as is, which the table shows as a length equal to the
+block size.
+"""
+
+import lzma
+import struct
+import zlib
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+default_block_size = 1 << 20
+
+# Skip compression when a sample does not shrink below this fraction.
+skip_ratio = 0.95
+
+CODECS = {
+    "zlib": (lambda data: zlib.compress(data, 6), zlib.decompress),
+    "lzma": (lambda data: lzma.compress(data, preset=6), lzma.decompress),
+}
+if zstandard is not None:
+    CODECS["zstd"] = (
+        lambda data: zstandard.ZstdCompressor(level=3).compress(data),
+        lambda data: zstandard.ZstdDecompressor().decompress(data),
+    )
+
+TABLE_ENTRY = struct.Struct(">I")
+
+
+def default_codec():
+    return "zstd" if "zstd" in CODECS else "zlib"
+
+
+def compress_block(codec, data):
+    """Compressed block, or the block itself if it does not shrink."""
+    compressed = CODECS[codec][0](data)
+    return compressed if len(compressed) < len(data) else bytes(data)
+
+
+def decompress_block(codec, data, length):
+    """Undo compress_block for a block of length bytes."""
+    if len(data) == length:
+        return bytes(data)
+    return CODECS[codec][1](bytes(data))
+
+
+def probe_ratio(read, size, codec, samples=8, sample_size=1 << 16):
+    """Compressed to raw size ratio of samples spread over a stream of size
+    bytes, where read(offset, length) returns the stream's bytes."""
+    step = max(sample_size, size // samples)
+    raw = compressed = 0
+    for offset in range(0, size, step):
+        data = read(offset, min(sample_size, size - offset))
+        raw += len(data)
+        compressed += len(compress_block(codec, data))
+    return compressed / raw if raw else 1.0
+
+
+def block_spans(size, block_size):
+    """(offset, length) of the blocks of a stream of size bytes."""
+    return [
+        (offset, min(block_size, size - offset))
+        for offset in range(0, size, block_size)
+    ]
+
+
+def pack_table(lengths):
+    return b"".join(TABLE_ENTRY.pack(length) for length in lengths)
+
+
+def unpack_table(data):
+    return [length for (length,) in TABLE_ENTRY.iter_unpack(bytes(data))]
+
+
+def block_offsets(table, table_size):
+    """Offset of every compressed block in the compressed stream."""
+    offsets = []
+    offset = table_size
+    for length in table:
+        offsets.append(offset)
+        offset += length
+    return offsets
+
+
+def decompress_stream(src, dest, codec, block_size, size, table_size):
+    """Decompress a compressed stream file into dest, size bytes long."""
+    with open(src, "rb") as f, open(dest, "wb") as out:
+        table = unpack_table(f.read(table_size))
+        for (_, length), compressed in zip(block_spans(size, block_size), table):
+            out.write(decompress_block(codec, f.read(compressed), length))
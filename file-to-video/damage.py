@@ -0,0 +1,72 @@
+"""Damage maps: the byte ranges a partial decode could not recover.
+
+A partial decode leaves the chunks it cannot decode as zeros in the output
+file and records them in a JSON file next to it, as [offset, length]
+ranges of the decoded chunk stream. A later repair run re-decodes only
+those ranges, from the same video or another copy of it, and shrinks the
+map until nothing is left.
+"""
+
+import json
+import os
+
+
+def damage_path(dest):
+    return dest + ".damage.json"
+
+
+def chunk_ranges(chunks, chunk_size, size):
+    """Merged [offset, length] ranges of a stream of size bytes covered by
+    the given chunk indices."""
+    ranges = []
+    for chunk in sorted(set(chunks)):
+        offset = chunk * chunk_size
+        length = min(chunk_size, size - offset)
+        if ranges and ranges[-1][0] + ranges[-1][1] == offset:
+            ranges[-1][1] += length
+        else:
+            ranges.append([offset, length])
+    return ranges
+
+
+def merge_ranges(ranges):
+    """Sorted ranges with touching and overlapping ones joined."""
+    merged = []
+    for offset, length in sorted(ranges):
+        if merged and offset <= merged[-1][0] + merged[-1][1]:
+            end = max(merged[-1][0] + merged[-1][1], offset + length)
+            merged[-1][1] = end - merged[-1][0]
+        else:
+            merged.append([offset, length])
+    return merged
+
+
+def split_ranges(ranges, step):
+    """Cut ranges at multiples of step, e.g. at task boundaries, so each
+    piece can be recovered or fail on its own."""
+    pieces = []
+    for offset, length in ranges:
+        end = offset + length
+        while offset < end:
+            stop = min(end, (offset // step + 1) * step)
+            pieces.append([offset, stop - offset])
+            offset = stop
+    return pieces
+
+
+def write_damage_map(dest, filename, size, ranges):
+    """Record the damaged ranges of dest, or remove its map if there are
+    none. filename and size identify the stream the ranges refer to."""
+    path = damage_path(dest)
+    if not ranges:
+        if os.path.exists(path):
+            os.remove(path)
+        return
+    damage = {"Filename": filename, "FileSize": size, "Ranges": ranges}
+    with open(path, "w") as f:
+        json.dump(damage, f, indent=4)
+
+
+def read_damage_map(dest):
+    with open(damage_path(dest)) as f:
+        return json.load(f)
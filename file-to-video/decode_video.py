@@ -1,19 +1,83 @@
-import cv2
+import av
+import bisect
 import json
+import math
 import os
+import queue
 import sys
 import logging
+import zlib
+from collections import namedtuple
+import numpy as np
 from tqdm import tqdm
 from multiprocessing import Pool, cpu_count
-from reedsolo import RSCodec
+from reedsolo import RSCodec, ReedSolomonError
 
 from common import *
 
-from v2 import decode_from_image
+from v2 import (
+    MODULATIONS,
+    decode_from_image,
+    decode_with_margins,
+    default_grid,
+    frame_capacity,
+)
+from framering import FrameRing
+from frameheader import (
+    DATA,
+    FORMAT_VERSION,
+    HEADER,
+    PARITY,
+    RUN,
+    FrameHeader,
+    header_length,
+    unpack_header,
+    unpack_run,
+)
+from interleave import deinterleave, encoded_length, interleave
+from parity import recover_frames
+from segments import read_manifest
+from archive import find_member, member_path, unpack_archive, unpack_index, write_member
+from compress import block_offsets, decompress_block, decompress_stream, unpack_table
+from damage import (
+    chunk_ranges,
+    damage_path,
+    merge_ranges,
+    read_damage_map,
+    split_ranges,
+    write_damage_map,
+)
+from whiten import whiten
 
 rs = None
 reedEC = None
 grid_size = None
+ring = None
+meta_data = None
+legacy = False
+calibrated = False
+modulation = "binary"
+block = 1
+whitening = None
+# Pixel format frames are decoded to: the Y plane alone, unless a chroma
+# modulation needs all three planes.
+frame_format = "gray"
+chunk_size = None
+depth = 1
+parity_frames = 0
+task_size = 1
+# Leave chunks that cannot be decoded as zeros and carry on, rather than
+# failing the whole decode.
+partial = False
+# Frames read from each video at a time when repairing, bounding the
+# Samples held in memory.
+repair_frames = 256
+# Pixel formats whose first plane is 8-bit luma, which frame_image can view.
+EIGHT_BIT_FORMATS = ("yuv420p", "yuvj420p", "yuv422p", "yuv444p", "gray")
+
+# A sampled frame: its payload, whether it matched its CRC, and unless it
+# did, the margin of every payload byte.
+Sample = namedtuple("Sample", "payload clean margins crc")
 
 # Setup basic logging
 logging.basicConfig(
@@ -22,8 +86,24 @@ logging.basicConfig(
 
 
 def process_frame(frame):
-    data = decode_from_image(frame, grid_size)
+    """Decode a frame with a 4-byte length prefix, e.g. the metadata frame.
+
+    Calibrated videos calibrate this frame too. A fixed threshold reads it
+    all the same unless the lighting shifted, which fails RS decoding or,
+    with a frame gone all black, reads as empty.
+    """
+    try:
+        data = read_prefixed(decode_from_image(frame, grid_size))
+    except ReedSolomonError:
+        data = None
+    if not data:
+        data, _ = decode_with_margins(frame, grid_size, calibrated=True)
+        data = read_prefixed(data)
+    return data
 
+
+def read_prefixed(data):
+    """RS-decode the length-prefixed payload at the start of a frame's bytes."""
     length_encoded = data[: (4 + reedEC)]
     length_decoded, _, _ = rs.decode(length_encoded)
 
@@ -36,16 +116,983 @@ def process_frame(frame):
     return data
 
 
-def decode_video(cap, dest_folder, reedEC, grid_size):
+def read_slot(slot, position):
+    """read_frame on the frame the parent copied into a ring slot; returns
+    the slot, now free again, and the result."""
+    return slot, read_frame(ring[slot], position)
+
+
+def read_frame(frame, position):
+    """Sample a frame and decode only its header.
+
+    Returns (kind, index, sample), with sample a Sample, or None if the
+    header is unreadable. Frames of videos made before frame headers are
+    indexed by their position after the metadata frame. The payload of a
+    run frame is decoded into its Run instead.
+    """
+    data, margins = decode_with_margins(
+        frame, grid_size, calibrated, modulation, block
+    )
+    if whitening is not None:
+        data = whiten(data, whitening)
+    try:
+        if legacy:
+            length, _, _ = rs.decode(data[: (4 + reedEC)])
+            header = FrameHeader(DATA, position, 0, int.from_bytes(length, "big"), None)
+            start = 4 + reedEC
+        else:
+            start = header_length(reedEC)
+            try:
+                header = unpack_header(data, rs)
+            except ReedSolomonError:
+                # No CRC guards the header, so keep half the parity for errors.
+                message, _ = soft_correct(data[:start], margins[:start], reedEC // 2)
+                header = FrameHeader(*HEADER.unpack(bytes(message)))
+    except ReedSolomonError:
+        return None
+    payload = bytes(data[start : start + header.length])
+    clean = zlib.crc32(payload) == header.crc
+    if header.kind == RUN:
+        try:
+            decoded = strip_parity(payload) if clean else rs.decode(payload)[0]
+        except ReedSolomonError:
+            return None
+        return RUN, header.index, unpack_run(header.index, decoded)
+    if clean:
+        margins = None
+    else:
+        margins = margins[start : start + header.length].tobytes()
+    return header.kind, header.index, Sample(payload, clean, margins, header.crc)
+
+
+def soft_correct(codeword, margins, most, erased=()):
+    """RS-decode one codeword, falling back to erasure decoding.
+
+    A known erasure costs one parity symbol instead of the two an error
+    costs. erased lists the positions known to be lost, e.g. those of a
+    frame missing from an interleaving group, which are always erasures.
+    If decoding fails, up to most erasures in all are made by adding the
+    least reliable other bytes in turn, and of the candidates that decode
+    the one changing the least total margin wins, the generalized minimum
+    distance rule. Returns the message and the corrected codeword.
+    """
+    erased = list(erased)
+    try:
+        message, full, _ = rs.decode(codeword, erase_pos=erased)
+        return message, full
+    except ReedSolomonError as error:
+        failure = error
+    margins = np.frombuffer(bytes(margins), dtype=np.uint8)
+    received = np.frombuffer(bytes(codeword), dtype=np.uint8)
+    order = np.argsort(margins, kind="stable")
+    order = order[~np.isin(order, erased)].tolist()
+    best = None
+    for count in range(1, most - len(erased) + 1):
+        try:
+            positions = sorted(erased + order[:count])
+            message, full, _ = rs.decode(codeword, erase_pos=positions)
+        except ReedSolomonError as error:
+            failure = error
+            continue
+        changed = np.frombuffer(bytes(full), dtype=np.uint8) != received
+        cost = int(margins[changed].sum())
+        if best is None or cost < best[0]:
+            best = (cost, message, full)
+    if best is None:
+        raise failure
+    return best[1], best[2]
+
+
+def soft_decode(encoded, margins, most, lost=None):
+    """soft_correct every codeword of a payload, with the bytes lost marks
+    nonzero as known erasures; returns the data and the corrected
+    codewords."""
+    data = bytearray()
+    corrected = bytearray()
+    for i in range(0, len(encoded), global_reedN):
+        end = i + global_reedN
+        erased = [] if lost is None else np.flatnonzero(lost[i:end]).tolist()
+        message, full = soft_correct(encoded[i:end], margins[i:end], most, erased)
+        data += message
+        corrected += full
+    return data, corrected
+
+
+def strip_parity(encoded):
+    """Data bytes of an RS-encoded payload that is known to be error free."""
+    starts = range(0, len(encoded), global_reedN)
+    return b"".join(encoded[i : i + global_reedN][:-reedEC] for i in starts)
+
+
+def decode_group(samples, first_chunk):
+    """Decode the Samples of one interleaving group starting at first_chunk.
+
+    Payloads whose CRC already matched skip RS decoding; the others are
+    decoded with the least reliable bytes as erasures where needed, and must
+    match their CRC once corrected. A frame missing from the group, None in
+    samples, is all erasures, which interleaving spreads thinly enough over
+    the codewords for the rest of the group to fill in. Returns the data of
+    each frame and the corrected payloads as they were rasterized.
+    """
+    file_size = meta_data["FileSize:"]
+    lengths = [
+        encoded_length(min(chunk_size, file_size - i * chunk_size), reedEC)
+        for i in range(first_chunk, first_chunk + len(samples))
+    ]
+    present = [sample for sample in samples if sample is not None]
+    lost = [bytes([sample is None]) * n for sample, n in zip(samples, lengths)]
+    samples = [
+        Sample(bytes(n), False, bytes(n), None) if sample is None else sample
+        for sample, n in zip(samples, lengths)
+    ]
+    payloads = [sample.payload[:n] for sample, n in zip(samples, lengths)]
+    if len(payloads) > 1:
+        encoded = deinterleave(payloads, lengths)
+    else:
+        encoded = payloads
+    if all(sample.clean for sample in samples):
+        return [strip_parity(e) for e in encoded], payloads
+
+    margins = [
+        bytes([255]) * n if sample.margins is None else sample.margins[:n]
+        for sample, n in zip(samples, lengths)
+    ]
+    if len(payloads) > 1:
+        margins = deinterleave(margins, lengths)
+        lost = deinterleave(lost, lengths)
+    # Without a CRC to catch miscorrections, keep half the parity for errors.
+    checked = all(sample.crc is not None for sample in present)
+    most = reedEC if checked else reedEC // 2
+    datas, corrected = zip(
+        *[soft_decode(e, m, most, g) for e, m, g in zip(encoded, margins, lost)]
+    )
+    if len(payloads) > 1:
+        corrected = interleave(corrected)
+    for sample, payload in zip(samples, corrected):
+        if sample.crc is not None and zlib.crc32(payload) != sample.crc:
+            raise ReedSolomonError("corrected payload does not match its CRC")
+    return list(datas), list(corrected)
+
+
+def combine_samples(copies):
+    """One Sample from the Samples of a frame read from several copies of
+    the video.
+
+    Each byte takes the value with the most support, the sum of the
+    margins, plus one, of the copies that read it, so that copies agreeing
+    outvote one that is sure and copies that disagree defer to the surest.
+    Its margin is the winning support less the rest, for soft decoding.
+    """
+    if len(copies) == 1:
+        return copies[0]
+    length = min(len(sample.payload) for sample in copies)
+    values = np.stack(
+        [np.frombuffer(sample.payload, dtype=np.uint8)[:length] for sample in copies]
+    )
+    margins = np.stack(
+        [np.frombuffer(sample.margins, dtype=np.uint8)[:length] for sample in copies]
+    ).astype(np.int32)
+    agree = values[:, None, :] == values[None, :, :]
+    support = (agree * (margins + 1)[None, :, :]).sum(axis=1)
+    best = support.argmax(axis=0)
+    column = np.arange(length)
+    payload = values[best, column].tobytes()
+    margin = 2 * support[best, column] - (margins + 1).sum(axis=0)
+    crc = copies[0].crc
+    if crc is not None and zlib.crc32(payload) == crc:
+        return Sample(payload, True, None, crc)
+    margin = np.clip(margin, 0, 255).astype(np.uint8).tobytes()
+    return Sample(payload, False, margin, crc)
+
+
+def decode_copies(copies, samples, first_chunk):
+    """decode_group on a group's combined Samples, falling back to the
+    frames of each copy on their own; copies holds the Samples of every
+    frame of the group, one per copy read, or None for a missing frame."""
+    groups = [samples]
+    if any(frame and len(frame) > 1 for frame in copies):
+        count = max(len(frame) for frame in copies if frame)
+        groups += [
+            [frame and frame[min(i, len(frame) - 1)] for frame in copies]
+            for i in range(count)
+        ]
+    for group in groups:
+        try:
+            return decode_group(group, first_chunk)
+        except ReedSolomonError as error:
+            failure = error
+    raise failure
+
+
+def decode_task(task, frames):
+    """Decode one task: task_size data frames plus their parity frames.
+
+    frames maps (kind, index) to the Samples of each frame of the task
+    that were read, one per copy of the video. Interleaving groups that
+    fail to decode or are missing are rebuilt from the rest of the task.
+    Returns the first chunk index, the data of each chunk and how many
+    frames were rebuilt. In a partial decode, chunks that cannot be
+    recovered are None instead of failing the task.
+    """
+    first_chunk = task * task_size
+    data_frames = task_data_frames(task)
+    keys = [(DATA, first_chunk + i) for i in range(data_frames)]
+    keys += [(PARITY, task * parity_frames + p) for p in range(parity_frames)]
+    copies = [frames.get(key) for key in keys]
+    samples = [None if c is None else combine_samples(c) for c in copies]
+    payloads = [None if sample is None else sample.payload for sample in samples]
+
+    datas = [None] * data_frames
+    failed = []
+    for start in range(0, data_frames, depth):
+        stop = min(start + depth, data_frames)
+        # Missing frames are erasures, within reach of RS when interleaved.
+        if any(sample is not None for sample in samples[start:stop]):
+            try:
+                datas[start:stop], payloads[start:stop] = decode_copies(
+                    copies[start:stop], samples[start:stop], first_chunk + start
+                )
+                continue
+            except ReedSolomonError:
+                if not parity_frames and not partial:
+                    raise
+        failed.extend(range(start, stop))
+
+    lost_parity = [i for i in range(data_frames, len(keys)) if payloads[i] is None]
+    erased = failed + lost_parity
+    if len(erased) > parity_frames:
+        if partial:
+            return first_chunk, datas, 0
+        raise ReedSolomonError(
+            f"{len(erased)} frames lost from chunk {first_chunk} on, "
+            f"only {parity_frames} parity frames"
+        )
+    if failed:
+        capacity = frame_capacity(grid_size, calibrated, modulation)
+        capacity -= header_length(reedEC)
+        rebuilt = recover_frames(payloads, erased, parity_frames, capacity)
+        for i, payload in zip(failed, rebuilt):
+            payloads[i] = payload
+            samples[i] = Sample(payload, False, None, None)
+        for start in failed[::depth]:
+            stop = min(start + depth, data_frames)
+            group = samples[start:stop]
+            try:
+                datas[start:stop], _ = decode_group(group, first_chunk + start)
+            except ReedSolomonError:
+                if not partial:
+                    raise
+    return first_chunk, datas, len(failed)
+
+
+def task_data_frames(task):
+    """Number of data frames in a task; the last one may be short."""
+    return min(task_size, meta_data["ChunkCount"] - task * task_size)
+
+
+def task_count():
+    return math.ceil(meta_data["ChunkCount"] / task_size)
+
+
+def task_of(kind, index):
+    """Task a frame belongs to, or None for an index out of range."""
+    if kind in (DATA, RUN) and index < meta_data["ChunkCount"]:
+        return index // task_size
+    if kind == PARITY and index < task_count() * parity_frames:
+        return index // parity_frames
+    return None
+
+
+class TaskAssembler:
+    """Files sampled frames under the task they belong to.
+
+    Keeps the Samples of a frame in a list: the first whose CRC matched or
+    else the latest copies up to copies of them, for decode_task to
+    combine. Hands a task out for decoding once all its frames are in or,
+    given a window, once it is more than window tasks behind the
+    newest task seen. Tasks covered by a run frame count as decoded; their
+    Runs are kept by first chunk for expand_runs. Chunks a partial decode
+    lost are listed in lost.
+    """
+
+    def __init__(self, window=None, copies=1):
+        self.window = window
+        self.copies = copies
+        self.pending = {}
+        self.decoded = set()
+        self.runs = {}
+        self.newest = 0
+        self.unreadable = 0
+        self.duplicates = 0
+        self.lost = []
+
+    def add(self, head):
+        """File a read_frame result."""
+        task = None if head is None else task_of(head[0], head[1])
+        if task is None:
+            self.unreadable += 1
+            return
+        kind, index, sample = head
+        if kind == RUN:
+            self.add_run(sample)
+        else:
+            self.add_frame(task, (kind, index), sample)
+
+    def add_run(self, run):
+        if run.first in self.runs:
+            # Run frames are written once per parity frame plus one.
+            return
+        self.runs[run.first] = run
+        tasks = range(run.first // task_size, (run.first + run.count) // task_size)
+        self.decoded.update(tasks)
+        self.newest = max(self.newest, tasks[-1])
+
+    def run_of(self, task):
+        """The Run covering a task, or None."""
+        chunk = task * task_size
+        for run in self.runs.values():
+            if run.first <= chunk < run.first + run.count:
+                return run
+        return None
+
+    def add_frame(self, task, key, sample):
+        frames = self.pending.get(task, {})
+        if task in self.decoded or key in frames:
+            self.duplicates += 1
+        if task in self.decoded or key in frames and frames[key][0].clean:
+            return
+        kept = [sample]
+        if not sample.clean:
+            kept = (frames.get(key, []) + kept)[-self.copies :]
+        self.pending.setdefault(task, {})[key] = kept
+        self.newest = max(self.newest, task)
+
+    def merge(self, other):
+        """Take over the frames and decoded tasks of another assembler."""
+        self.unreadable += other.unreadable
+        self.duplicates += other.duplicates
+        self.lost += other.lost
+        self.decoded |= other.decoded
+        for run in other.runs.values():
+            self.add_run(run)
+        for task, frames in other.pending.items():
+            for key, samples in frames.items():
+                for sample in samples:
+                    self.add_frame(task, key, sample)
+
+    def complete(self, task):
+        """Whether every frame of a task is in."""
+        frames = self.pending.get(task, {})
+        return len(frames) == task_data_frames(task) + parity_frames
+
+    def ready(self):
+        """Pop the tasks ready for decoding as (task, frames) pairs."""
+        tasks = [
+            task
+            for task in self.pending
+            if self.complete(task)
+            or self.window is not None
+            and task < self.newest - self.window
+        ]
+        self.decoded.update(tasks)
+        return [(task, self.pending.pop(task)) for task in tasks]
+
+    def inner(self, first, last):
+        """Pop the tasks after first and before last as (task, frames) pairs.
+
+        Frames come task by task, so between the tasks of the first and last
+        frames of a range lie tasks whose frames were all in it.
+        """
+        tasks = [task for task in self.pending if first < task < last]
+        self.decoded.update(tasks)
+        return [(task, self.pending.pop(task)) for task in tasks]
+
+    def flush(self):
+        """Pop every remaining task, including tasks none of whose frames
+        were seen, so that their loss is reported."""
+        tasks = [task for task in range(task_count()) if task not in self.decoded]
+        self.decoded.update(tasks)
+        return [(task, self.pending.pop(task, {})) for task in tasks]
+
+
+def write_chunks(fd, first_chunk, datas):
+    """Write decoded chunks at their offsets in the output file.
+
+    Returns the indices of the chunks that were lost, None in datas, which
+    are left as zeros.
+    """
+    lost = []
+    for i, data in enumerate(datas):
+        if data is None:
+            lost.append(first_chunk + i)
+        else:
+            os.pwrite(fd, data, (first_chunk + i) * chunk_size)
+    return lost
+
+
+def expand_runs(fd, assembler):
+    """Fill in the chunks of run frames once all data chunks are written.
+
+    Zero runs are already zeros in the preallocated file; repeat runs copy
+    their source chunk, or are lost with it.
+    """
+    lost = set(assembler.lost)
+    for run in assembler.runs.values():
+        if run.source < 0:
+            continue
+        if run.source in lost:
+            assembler.lost += range(run.first, run.first + run.count)
+            continue
+        data = os.pread(fd, chunk_size, run.source * chunk_size)
+        write_chunks(fd, run.first, [data] * run.count)
+
+
+def submit(pool, done, func, args):
+    """Run func in the pool, putting (func, result) on done when it
+    returns, or (None, exception) if it raises."""
+    pool.apply_async(
+        func,
+        args,
+        callback=lambda result: done.put((func, result)),
+        error_callback=lambda error: done.put((None, error)),
+    )
+
+
+def decode_frames(cap, pool, fd, pbar):
+    """Keep the workers busy with the frames of the video.
+
+    A frame is read into a ring slot and handed to a worker as soon as the
+    slot is free, and workers take frames and tasks as they finish others,
+    so a slow frame holds up nothing but itself. Workers sample each frame
+    and decode its header, the parent files the frames by task and has
+    ready tasks decoded in the pool. Data is written at its chunk's offset
+    in whatever order tasks complete. Returns the assembler and the number
+    of frames rebuilt from parity.
+    """
+    window = 4 * max(1, ring.slots // (task_size + parity_frames))
+    assembler = TaskAssembler(window)
+    done = queue.SimpleQueue()
+    free = list(range(ring.slots))
+    position = 0
+    running = 0
+    rebuilt = 0
+    ended = flushed = False
+    while True:
+        while free and not ended:
+            ret, frame = cap.read()
+            if not ret:
+                ended = True
+                break
+            slot = free.pop()
+            ring[slot][...] = frame
+            submit(pool, done, read_slot, (slot, position))
+            position += 1
+            running += 1
+
+        if ended and not flushed and len(free) == ring.slots:
+            # Every frame is filed; decode what is left, gaps and all.
+            for job in assembler.flush():
+                submit(pool, done, decode_task, job)
+                running += 1
+            flushed = True
+        if not running:
+            return assembler, rebuilt
+
+        func, result = done.get()
+        running -= 1
+        if func is None:
+            raise result
+        if func is read_slot:
+            slot, head = result
+            free.append(slot)
+            pbar.update(1)
+            assembler.add(head)
+            for job in assembler.ready():
+                submit(pool, done, decode_task, job)
+                running += 1
+        else:
+            first_chunk, datas, count = result
+            rebuilt += count
+            assembler.lost += write_chunks(fd, first_chunk, datas)
+
+
+def probe_timestamps(src):
+    """Sorted pts of all frames and of the keyframes of a video.
+
+    Only demuxes the packets, without decoding them, but reads the whole
+    file; decoding a range seeks by frame_pts instead.
+    """
+    with av.open(src) as container:
+        stream = container.streams.video[0]
+        timestamps = []
+        keyframes = []
+        for packet in container.demux(stream):
+            if packet.pts is None:
+                continue
+            timestamps.append(packet.pts)
+            if packet.is_keyframe:
+                keyframes.append(packet.pts)
+    timestamps.sort()
+    keyframes.sort()
+    return timestamps, keyframes
+
+
+def keyframe_before(keyframes, pts):
+    """pts of the last keyframe at or before pts."""
+    return keyframes[max(0, bisect.bisect_right(keyframes, pts) - 1)]
+
+
+def probe_ranges(src, count):
+    """Split a video into up to count keyframe-aligned ranges.
+
+    Returns a list of (start_pts, end_pts), end_pts None for the last range.
+    """
+    timestamps, keyframes = probe_timestamps(src)
+    starts = []
+    for i in range(count):
+        keyframe = keyframe_before(keyframes, timestamps[len(timestamps) * i // count])
+        if keyframe not in starts:
+            starts.append(keyframe)
+    return list(zip(starts, starts[1:] + [None]))
+
+
+def frame_timing(stream):
+    """(first_pts, step) of a video stream: the metadata frame's pts and the
+    pts between frames at the constant frame rate we encode at."""
+    return stream.start_time or 0, 1 / (stream.average_rate * stream.time_base)
+
+
+def frame_pts(src, position):
+    """pts of the frame at position after the metadata frame, reckoned from
+    the frame rate without reading any packets."""
+    with av.open(src) as container:
+        first_pts, step = frame_timing(container.streams.video[0])
+    return first_pts + round((position + 1) * step)
+
+
+def open_video(src, threads=0):
+    """Open a video for decoding its stream on threads threads, 0 leaving
+    the count to the codec."""
+    container = av.open(src)
+    stream = container.streams.video[0]
+    stream.thread_type = "AUTO"
+    stream.thread_count = threads
+    return container, stream
+
+
+def frame_image(frame, format):
+    """A decoded frame as an array in format.
+
+    "gray" of an 8-bit frame is a view of its own Y plane, with no
+    conversion or copy; the luma modulations are drawn in Y, so it holds the
+    cells as encoded. Deeper formats such as yuv420p10le are converted.
+    """
+    if format != "gray" or frame.format.name not in EIGHT_BIT_FORMATS:
+        return frame.to_ndarray(format=format)
+    plane = frame.planes[0]
+    lines = np.frombuffer(plane, dtype=np.uint8).reshape(-1, plane.line_size)
+    return lines[: frame.height, : frame.width]
+
+
+def iter_frames(src, start_pts, end_pts, threads=0):
+    """Seek to the last keyframe at or before start_pts and yield (image,
+    position) for the frames up to end_pts, leaving out the metadata frame.
+
+    position is the frame number after the metadata frame, from the
+    frame's pts.
+    """
+    container, stream = open_video(src, threads)
+    with container:
+        first_pts, step = frame_timing(stream)
+        container.seek(start_pts, backward=True, stream=stream)
+        for frame in container.decode(stream):
+            if end_pts is not None and frame.pts >= end_pts:
+                break
+            position = round((frame.pts - first_pts) / step) - 1
+            if position >= 0:
+                yield frame_image(frame, frame_format), position
+
+
+def decode_keyframe_range(src, dest, start_pts, end_pts, threads):
+    """Decode the frames of one keyframe-aligned range in a worker process.
 
+    The worker opens its own container, seeks to start_pts and decodes up to
+    end_pts on threads codec threads, RS-decoding every task that is
+    complete within the range and writing it straight into dest. Once the
+    range is read, tasks that lie wholly inside it are decoded too, gaps and
+    all. Returns the assembler, whose pending tasks straddle the range's
+    edges and are left to the parent, the number of frames rebuilt from
+    parity and the number of frames read.
+    """
+    assembler = TaskAssembler()
+    rebuilt = 0
+    read = 0
+    first = last = None
+    fd = os.open(dest, os.O_WRONLY)
+
+    def decode_jobs(jobs):
+        nonlocal rebuilt
+        for task, frames in jobs:
+            first_chunk, datas, count = decode_task(task, frames)
+            rebuilt += count
+            assembler.lost += write_chunks(fd, first_chunk, datas)
+
+    for image, index in iter_frames(src, start_pts, end_pts, threads):
+        head = read_frame(image, index)
+        read += 1
+        task = None if head is None else task_of(head[0], head[1])
+        if task is not None:
+            first = task if first is None else first
+            last = task
+        assembler.add(head)
+        decode_jobs(assembler.ready())
+    if first is not None:
+        decode_jobs(assembler.inner(first, last))
+    os.close(fd)
+    return assembler, rebuilt, read
+
+
+def decode_range_job(job):
+    """decode_keyframe_range on a tuple of its arguments, for imap."""
+    return decode_keyframe_range(*job)
+
+
+def decode_ranges(src, pool, fd, dest, pbar):
+    """Decode keyframe-aligned ranges of src in parallel worker processes,
+    then decode the tasks that straddle range edges from the frames the
+    workers handed back. Returns the assembler and the frames rebuilt.
+
+    There are several ranges per worker, handed out one at a time, so a
+    slow range does not leave the other workers idle at the end. Ranges are
+    merged in whatever order they finish.
+    """
+    ranges = probe_ranges(src, 4 * cpu_count())
+    # Short videos have fewer ranges than cores; their codecs take the rest.
+    threads = max(1, cpu_count() // len(ranges))
+    jobs = [(src, dest) + span + (threads,) for span in ranges]
+    assembler = TaskAssembler()
+    rebuilt = 0
+    for partial, count, read in pool.imap_unordered(decode_range_job, jobs):
+        assembler.merge(partial)
+        rebuilt += count
+        pbar.update(read)
+
+    for first_chunk, datas, count in pool.starmap(decode_task, assembler.flush()):
+        rebuilt += count
+        assembler.lost += write_chunks(fd, first_chunk, datas)
+    return assembler, rebuilt
+
+
+def read_metadata(first_frame, grid_size):
+    """process_frame on the metadata frame, which is on the default grid for
+    its size, or for videos made before that, a grid_size grid stretched
+    over the frame."""
+    height, width = first_frame.shape[:2]
+    for grid in dict.fromkeys([default_grid((width, height)), grid_size]):
+        globals()["grid_size"] = grid
+        try:
+            data = process_frame(first_frame)
+        except ReedSolomonError:
+            continue
+        if data:
+            return data
+    raise ReedSolomonError("cannot read the metadata frame")
+
+
+def load_metadata(first_frame, reedEC, grid_size):
+    """Decode the metadata frame and set up the decoding parameters it
+    records for this process and the workers it forks."""
     globals()["grid_size"] = grid_size
     globals()["rs"] = RSCodec(nsym=reedEC, nsize=global_reedN)
     globals()["reedEC"] = reedEC
 
+    metadata = read_metadata(first_frame, grid_size)
+    meta_data = json.loads(metadata.decode("utf8"))
+
+    # The metadata frame uses the defaults; data frames use what it records.
+    reedEC = meta_data.get("ReedEC", reedEC)
+    grid_size = meta_data.get("GridSize", grid_size)
+    if isinstance(grid_size, list):
+        # [width, height] of a non-square grid; a tuple keeps it hashable.
+        grid_size = tuple(grid_size)
+    legacy = meta_data.get("Version", 1) < FORMAT_VERSION
+    if legacy:
+        reedK = global_reedN - reedEC
+        chunk_size = reedK * (grid_size**2 // (global_reedN * 8)) - (4 + reedEC)
+    else:
+        chunk_size = meta_data["ChunkSize"]
+    parity_frames = meta_data.get("ParityFrames", 0)
+    depth = meta_data.get("Interleave", 1)
+    globals()["grid_size"] = grid_size
+    globals()["rs"] = RSCodec(nsym=reedEC, nsize=global_reedN)
+    globals()["reedEC"] = reedEC
+    globals()["meta_data"] = meta_data
+    globals()["legacy"] = legacy
+    globals()["calibrated"] = meta_data.get("Calibration", False)
+    modulation = meta_data.get("Modulation", "binary")
+    globals()["modulation"] = modulation
+    globals()["block"] = meta_data.get("MacroblockCells", 1)
+    globals()["whitening"] = meta_data.get("Whitening")
+    globals()["frame_format"] = "yuv420p" if MODULATIONS[modulation][1] else "gray"
+    globals()["chunk_size"] = chunk_size
+    globals()["depth"] = depth
+    globals()["parity_frames"] = parity_frames
+    globals()["task_size"] = meta_data["ParityGroup"] if parity_frames else depth
+    return meta_data
+
+
+def probe_metadata(src, reedEC, grid_size):
+    """load_metadata from the first frame of a video file; returns the
+    video's frame count."""
+    container, stream = open_video(src, threads=1)
+    with container:
+        first_frame = frame_image(next(container.decode(stream)), "gray")
+        total_frames = stream.frames
+    load_metadata(first_frame, reedEC, grid_size)
+    return total_frames
+
+
+def decode_range(src, offset, length, reedEC, grid_size):
+    """Return length bytes of the encoded file starting at offset.
+
+    Only the frames holding the range are decoded, or for a compressed
+    video those holding the blocks that cover it.
+    """
+    probe_metadata(src, reedEC, grid_size)
+    if "Compression" in meta_data:
+        return read_compressed(src, offset, length)
+    return read_stream(src, offset, length)
+
+
+def read_compressed(src, offset, length):
+    """read_stream for the original bytes of a compressed stream: reads the
+    block table up to the last block needed, then the blocks themselves."""
+    codec = meta_data["Compression"]
+    block_size = meta_data["BlockSize"]
+    size = meta_data["OriginalSize"]
+    end = min(offset + length, size)
+    if offset >= end:
+        return b""
+    first = offset // block_size
+    last = (end - 1) // block_size
+    table = unpack_table(read_stream(src, 0, (last + 1) * 4))
+    offsets = block_offsets(table, meta_data["BlockTableSize"])
+    start = offsets[first]
+    data = read_stream(src, start, offsets[last] + table[last] - start)
+
+    blocks = []
+    for block in range(first, last + 1):
+        low = offsets[block] - start
+        compressed = data[low : low + table[block]]
+        raw_length = min(block_size, size - block * block_size)
+        blocks.append(decompress_block(codec, compressed, raw_length))
+    base = first * block_size
+    return b"".join(blocks)[offset - base : end - base]
+
+
+def first_task_at(src, pts):
+    """Task of the first readable frame from the keyframe before pts on, or
+    None.
+
+    Decodes on one thread, as frame threading would decode several frames
+    before handing out the first.
+    """
+    for image, index in iter_frames(src, pts, None, threads=1):
+        head = read_frame(image, index)
+        task = None if head is None else task_of(head[0], head[1])
+        if task is not None:
+            return task
+    return None
+
+
+def search_keyframe(src, task):
+    """Bisect for a pts whose keyframe's first frame belongs to a task
+    before task, decoding one frame or so per step.
+
+    Steps go by the KeyframeInterval every video with runs records, so
+    each tries another keyframe.
+    """
+    with av.open(src) as container:
+        frames = container.streams.video[0].frames
+    interval = meta_data["KeyframeInterval"]
+    found = frame_pts(src, -1)
+    low, high = 1, (frames - 1) // interval
+    while low <= high:
+        middle = (low + high) // 2
+        pts = frame_pts(src, middle * interval - 1)
+        first = first_task_at(src, pts)
+        if first is not None and first < task:
+            found = pts
+            low = middle + 1
+        else:
+            high = middle - 1
+    return found
+
+
+def read_stream(src, offset, length, copies=()):
+    """Return length bytes of the chunk stream of src starting at offset.
+
+    Only the tasks holding the chunks that cover the range are decoded.
+    Tasks covered by a run frame are filled in from the run's source
+    chunk. The frames of the same tasks are read from every other copy of
+    the video in copies too, and combined with src's.
+    """
+    end = min(offset + length, meta_data["FileSize:"])
+    if offset >= end:
+        return b""
+    tasks = stream_tasks(offset, end)
+    assembler = read_copies(src, tasks, copies)
+    datas = []
+    for task in tasks:
+        datas.extend(task_chunks(src, task, assembler, copies))
+    base = tasks[0] * task_size * chunk_size
+    return b"".join(datas)[offset - base : end - base]
+
+
+def stream_tasks(offset, end):
+    """The tasks holding the bytes from offset to end of the chunk stream."""
+    task_bytes = chunk_size * task_size
+    return range(offset // task_bytes, (end - 1) // task_bytes + 1)
+
+
+def read_copies(src, tasks, copies=()):
+    """Assembler holding the frames of a range of tasks read from src and
+    from every other copy of the video in copies."""
+    assembler = TaskAssembler(copies=1 + len(copies))
+    for video in (src,) + tuple(copies):
+        assembler.merge(read_tasks(video, tasks))
+    return assembler
+
+
+def task_chunks(src, task, assembler, copies=()):
+    """Data chunks of a task from the frames read into assembler, reading
+    a run's source chunk from the videos where needed."""
+    run = assembler.run_of(task)
+    if run is None:
+        return decode_task(task, assembler.pending.get(task, {}))[1]
+    if run.source < 0:
+        return [bytes(chunk_size)] * task_data_frames(task)
+    source = read_stream(src, run.source * chunk_size, chunk_size, copies)
+    return [source] * task_data_frames(task)
+
+
+def read_tasks(src, tasks):
+    """Assembler holding the frames of a range of tasks read from src.
+
+    The video is sought to the keyframe before the first of their frames,
+    its pts reckoned from the frame rate, and read until they are complete,
+    allowing one task's worth of frames of slack either way for frames lost
+    or duplicated in transit.
+    """
+    first_task, last_task = tasks[0], tasks[-1]
+    task_frames = task_size + parity_frames
+    start = max(0, first_task - 1) * task_frames
+    stop = (last_task + 2) * task_frames
+    if meta_data.get("Runs"):
+        # Run frames shift later frames forward by an unknown amount.
+        start_pts = search_keyframe(src, first_task)
+    else:
+        start_pts = frame_pts(src, start)
+
+    assembler = TaskAssembler()
+    for image, index in iter_frames(src, start_pts, None):
+        assembler.add(read_frame(image, index))
+        if index >= stop or all(
+            task in assembler.decoded or assembler.complete(task) for task in tasks
+        ):
+            break
+    return assembler
+
+
+def output_path(dest_folder):
+    """Where the decoded chunk stream goes.
+
+    A compressed stream or an archive is decoded into a packed file next to
+    where its file or directory goes, for finish_output to restore.
+    """
+    dest = os.path.join(dest_folder, meta_data["Filename"])
+    if "IndexSize" in meta_data or "Compression" in meta_data:
+        dest += ".packed"
+    return dest
+
+
+def open_output(dest_folder):
+    """Create the output file at its final size and return its descriptor."""
     if not os.path.exists(dest_folder):
         os.makedirs(dest_folder)
+    dest = output_path(dest_folder)
+    fd = os.open(dest, os.O_RDWR | os.O_CREAT | os.O_TRUNC, 0o644)
+    os.ftruncate(fd, meta_data["FileSize:"])
+    return dest, fd
+
+
+def finish_output(dest_folder, dest):
+    """Decompress the decoded packed file and restore an archive's files."""
+    target = os.path.join(dest_folder, meta_data["Filename"])
+    if "Compression" in meta_data:
+        out = target + ".archive" if "IndexSize" in meta_data else target
+        decompress_stream(
+            dest,
+            out,
+            meta_data["Compression"],
+            meta_data["BlockSize"],
+            meta_data["OriginalSize"],
+            meta_data["BlockTableSize"],
+        )
+        os.remove(dest)
+        dest = out
+    if "IndexSize" not in meta_data:
+        return
+    damaged = unpack_archive(dest, target, meta_data["IndexSize"])
+    os.remove(dest)
+    for name in damaged:
+        logging.warning(f"{name} does not match its digest")
+
+
+def lost_ranges(assembler):
+    """Byte ranges of the chunks a decode lost."""
+    return chunk_ranges(assembler.lost, chunk_size, meta_data["FileSize:"])
 
-    total_frames = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
+
+def record_damage(dest_folder, dest, ranges):
+    """Write the damage map of an output with damaged ranges, or restore
+    the output if there are none. A packed stream is kept as is until
+    repaired, as it cannot be unpacked with holes in it."""
+    size = meta_data["FileSize:"]
+    write_damage_map(dest, meta_data["Filename"], size, ranges)
+    if not ranges:
+        finish_output(dest_folder, dest)
+        return
+    damaged = sum(length for _, length in ranges)
+    logging.warning(
+        f"Lost {damaged} of {size} bytes in {len(ranges)} ranges, left as "
+        f"zeros in {dest}; see {damage_path(dest)}"
+    )
+
+
+def report(assembler, rebuilt):
+    if parity_frames:
+        logging.info(f"Rebuilt {rebuilt} frames from parity")
+    if assembler.unreadable or assembler.duplicates:
+        logging.info(
+            f"Skipped {assembler.unreadable} unreadable and "
+            f"{assembler.duplicates} duplicate frames"
+        )
+
+
+def frame_shape(first_frame):
+    """Shape of the data frames as decoded to frame_format, given the
+    metadata frame's Y plane."""
+    height, width = first_frame.shape[:2]
+    if frame_format == "yuv420p":
+        return (height * 3 // 2, width)
+    return first_frame.shape
+
+
+def decode_video(cap, dest_folder, reedEC, grid_size):
+    """Decode a capture sequentially, sampling frames in a worker pool."""
+
+    total_frames = cap.frame_count()
     pbar = tqdm(total=(total_frames - 1), desc="Processing Frames")
 
     ret, first_frame = cap.read()
@@ -53,47 +1100,155 @@ def decode_video(cap, dest_folder, reedEC, grid_size):
         logging.error("Cannot read first frame")
         return
 
-    metadata = process_frame(first_frame)
-    if metadata is None:
-        logging.error("No QR code in first frame; cannot proceed")
-        return
-    meta_data = json.loads(metadata.decode("utf8"))
-    dest = os.path.join(dest_folder, meta_data["Filename"])
-    file = open(dest, "wb")
+    load_metadata(first_frame, reedEC, grid_size)
+    cap.format = frame_format
+    dest, fd = open_output(dest_folder)
 
     # Start worker processes
     num_workers = cpu_count()
 
-    with Pool(num_workers) as pool:
-        while cap.isOpened():
-            frames = []
-            done = False
-            for _ in range(num_workers):
-                ret, frame = cap.read()
-                if ret:
-                    frames.append(frame)
-                else:
-                    done = True
-                    break
-
-            datas = pool.map(process_frame, frames)
+    # Frames go to the workers through shared memory instead of being
+    # pickled through the pool's task pipe.
+    globals()["ring"] = FrameRing(2 * num_workers, frame_shape(first_frame))
 
-            pbar.update(len(frames))
+    try:
+        with Pool(num_workers) as pool:
+            assembler, rebuilt = decode_frames(cap, pool, fd, pbar)
+    finally:
+        ring.close()
+    expand_runs(fd, assembler)
+    os.close(fd)
+    cap.release()
+    pbar.close()
+    record_damage(dest_folder, dest, lost_ranges(assembler))
+    report(assembler, rebuilt)
 
-            for data in datas:
-                file.write(data)
 
-            if done:
-                break
+def decode_parallel(src, dest_folder, reedEC, grid_size):
+    """Decode a video file with one worker per keyframe-aligned range, each
+    demuxing, decoding and RS-decoding its own part of the file."""
+    total_frames = probe_metadata(src, reedEC, grid_size)
+    dest, fd = open_output(dest_folder)
+    pbar = tqdm(total=max(0, total_frames - 1), desc="Processing Frames")
 
-    file.close()
-    cap.release()
+    with Pool(cpu_count()) as pool:
+        assembler, rebuilt = decode_ranges(src, pool, fd, dest, pbar)
+    expand_runs(fd, assembler)
+    os.close(fd)
     pbar.close()
+    record_damage(dest_folder, dest, lost_ranges(assembler))
+    report(assembler, rebuilt)
+
+
+def extract_file(src, name, dest_folder, reedEC, grid_size):
+    """Restore one file of an archive video under dest_folder, decoding only
+    the index frames and the frames holding that file."""
+    probe_metadata(src, reedEC, grid_size)
+    if "IndexSize" not in meta_data:
+        raise ValueError(f"{src} is not an archive")
+    index_size = meta_data["IndexSize"]
+    entries = unpack_index(decode_range(src, 0, index_size, reedEC, grid_size))
+    entry = find_member(entries, name)
+    data = decode_range(src, index_size + entry[1], entry[2], reedEC, grid_size)
+    if not write_member(dest_folder, entry, data):
+        logging.warning(f"{name} does not match its digest")
+    return member_path(dest_folder, name)
+
+
+def repair(src, dest_folder, reedEC, grid_size, copies=()):
+    """Re-decode the ranges a partial decode into dest_folder lost, reading
+    only their frames from src, the same video or another copy of the file,
+    combined with those of the copies of the same video in copies.
 
+    The damaged tasks are read from each video about repair_frames frames
+    at a time, then decoded one by one, so whatever can be recovered is
+    written even if the rest stays lost. The output is
+    restored once no damage is left. Returns the ranges still damaged.
+    """
+    probe_metadata(src, reedEC, grid_size)
+    globals()["partial"] = False
+    dest = output_path(dest_folder)
+    damage = read_damage_map(dest)
+    stream = (meta_data["Filename"], meta_data["FileSize:"])
+    if (damage["Filename"], damage["FileSize"]) != stream:
+        raise ValueError(f"{src} does not hold the stream damaged in {dest}")
 
-def decode(src, dest_folder, reedEC, grid_size):
-    cap = cv2.VideoCapture(src)
-    decode_video(cap, dest_folder, reedEC, grid_size)
+    task_bytes = chunk_size * task_size
+    batch = task_bytes * max(1, repair_frames // (task_size + parity_frames))
+    remaining = []
+    fd = os.open(dest, os.O_WRONLY)
+    for offset, length in split_ranges(damage["Ranges"], batch):
+        assembler = read_copies(src, stream_tasks(offset, offset + length), copies)
+        for low, size in split_ranges([[offset, length]], task_bytes):
+            task = low // task_bytes
+            try:
+                data = b"".join(task_chunks(src, task, assembler, copies))
+            except ReedSolomonError:
+                remaining.append([low, size])
+                continue
+            start = low - task * task_bytes
+            os.pwrite(fd, data[start : start + size], low)
+    os.close(fd)
+    remaining = merge_ranges(remaining)
+    record_damage(dest_folder, dest, remaining)
+    return remaining
+
+
+class ChainedCapture:
+    """Reads the parts of a multi-part set one after another as a single
+    capture, decoding frames to the pixel format in format with the
+    codec's frame threading."""
+
+    def __init__(self, parts):
+        self.parts = parts
+        self.format = "gray"
+        self.frames = self.iter_frames()
+
+    def iter_frames(self):
+        for part in self.parts:
+            container, stream = open_video(part)
+            with container:
+                for frame in container.decode(stream):
+                    yield frame_image(frame, self.format)
+
+    def read(self):
+        frame = next(self.frames, None)
+        return frame is not None, frame
+
+    def frame_count(self):
+        total = 0
+        for part in self.parts:
+            with av.open(part) as container:
+                total += container.streams.video[0].frames
+        return total
+
+    def release(self):
+        self.frames.close()
+
+
+def decode(src, dest_folder, reedEC, grid_size, partial=False, copies=()):
+    """Decode a video file or the parts listed in a manifest.
+
+    A partial decode carries on past chunks it cannot recover and writes a
+    damage map of them for repair. Given other copies of the same video,
+    e.g. other downloads or re-encodes, the tasks src cannot decode on its
+    own are decoded again from the frames of all copies combined.
+    """
+    if copies and src.endswith(".json"):
+        raise ValueError("copies combine with a single video file, not parts")
+    globals()["partial"] = partial or bool(copies)
+    if src.endswith(".json"):
+        decode_video(ChainedCapture(read_manifest(src)), dest_folder, reedEC, grid_size)
+    else:
+        decode_parallel(src, dest_folder, reedEC, grid_size)
+    if not copies or not os.path.exists(damage_path(output_path(dest_folder))):
+        return
+    remaining = repair(src, dest_folder, reedEC, grid_size, copies)
+    if remaining and not partial:
+        raise ReedSolomonError(
+            f"{len(remaining)} ranges lost in every copy; "
+            f"see {damage_path(output_path(dest_folder))}"
+        )
 
 
 if __name__ == "__main__":
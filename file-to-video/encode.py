@@ -1,127 +1,683 @@
-from itertools import islice
 import os
 import sys
 import math
 import json
+import mmap
+import tempfile
+import threading
+import time
 from multiprocessing import Pool, cpu_count
 import av
+import numpy as np
 from tqdm import tqdm
 from reedsolo import RSCodec
-from v2 import encode_to_image
+from v2 import (
+    default_grid,
+    encode_to_luma,
+    frame_capacity,
+    new_yuv420_frame,
+    plane_shape,
+)
+from framering import FrameRing
+from interleave import interleave
+from parity import encode_parity
+from frameheader import (
+    DATA,
+    FORMAT_VERSION,
+    PARITY,
+    RUN,
+    Run,
+    header_length,
+    pack_header,
+    pack_run,
+)
+from pipeline import DONE, Stage, StageQueue, format_report, run_stages
+from segments import concat_parts, part_paths, write_manifest
+from archive import Archive
+from chunkcache import ChunkCache, chunk_digest, default_cache_bytes
+from whiten import whiten
+from compress import (
+    block_spans,
+    compress_block,
+    default_block_size,
+    pack_table,
+    probe_ratio,
+    skip_ratio,
+)
 
 
 from common import *
 
 frame_rate = 20.0
-width_height = 1080
+# libx264's own default; seeking decodes up to this many frames to reach
+# the one wanted.
+default_keyframe_interval = 250
+# H.264 crf per modulation; multi-level luma needs finer quantization to
+# keep its levels apart (see bench_modulation.py).
+default_crf = {"binary": 40, "gray4": 30, "chroma": 40, "gray4-chroma": 30}
 
 
 rs = None
+reedEC = None
 grid_size = None
+resolution = default_resolution
+calibrated = False
+modulation = "binary"
+block = 1
+whitening = None
+chunk_size = None
+interleave_depth = 1
+parity_frames = 0
+task_size = 1
+keyframe_interval = default_keyframe_interval
+crf = default_crf["binary"]
+compression = None
+runs = False
+cache = None
+frame_buffer = None
+source = None
+ring = None
+
+
+def open_source(src):
+    """The source file mapped read-only, the Archive of a source directory
+    as is, or None for an empty file."""
+    if isinstance(src, Archive):
+        return src
+    with open(src, "rb") as f:
+        # mmap refuses empty files; there are no chunks to read then anyway.
+        if os.fstat(f.fileno()).st_size:
+            return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    return None
+
+
+def close_source(mapped):
+    """Unmap what open_source mapped; Archives hold no open files."""
+    if isinstance(mapped, mmap.mmap):
+        mapped.close()
+
+
+def map_source(src):
+    """Pool initializer: map the source file read-only in this worker, or
+    take over the Archive of a source directory."""
+    globals()["source"] = open_source(src)
+
+
+def read_span(mapped, offset, length):
+    """Bytes of an open_source result at a span; a view for a mapped file."""
+    if isinstance(mapped, Archive):
+        return mapped.read(offset, length)
+    return memoryview(mapped)[offset : offset + length]
+
+
+def read_source(offset, length):
+    """Bytes of the worker's source at a span; a view for a mapped file."""
+    return read_span(source, offset, length)
+
+
+def compress_span(span):
+    """Compress one block of the worker's source."""
+    offset, length = span
+    return compress_block(compression, read_source(offset, length))
+
+
+def probe_source(file_size):
+    return probe_ratio(read_source, file_size, compression)
+
+
+def compress_source(src, file_size, dest, block_size):
+    """Compress the source in independent blocks across a worker pool.
+
+    Returns the path of a temporary file holding the compressed stream and
+    the metadata describing it, or None if a probe of the source shows it
+    does not compress.
+    """
+    with Pool(cpu_count(), initializer=map_source, initargs=(src,)) as pool:
+        ratio = pool.apply(probe_source, (file_size,))
+        if ratio > skip_ratio:
+            print(f"{compression}: sample ratio {ratio:.2f}, storing uncompressed")
+            return None
+
+        spans = block_spans(file_size, block_size)
+        table_size = len(spans) * 4
+        folder = os.path.dirname(os.path.abspath(dest))
+        with tempfile.NamedTemporaryFile(
+            dir=folder, suffix=".compressed", delete=False
+        ) as f:
+            lengths = []
+            f.seek(table_size)
+            for block in pool.imap(compress_span, spans):
+                lengths.append(len(block))
+                f.write(block)
+            f.seek(0)
+            f.write(pack_table(lengths))
+            size = f.tell() + sum(lengths)
+
+    print(f"{compression}: {file_size} -> {size} bytes")
+    stream_meta = {
+        "Compression": compression,
+        "BlockSize": block_size,
+        "BlockTableSize": table_size,
+        "OriginalSize": file_size,
+    }
+    return f.name, size, stream_meta
 
 
-def read_in_chunks(file_object, chunk_size=1024):
-    """Generator to read a file piece by piece."""
-    while True:
-        data = file_object.read(chunk_size)
-        if not data:
-            break
-        yield data
-
-
-def process_chunk(data):
-    """Encode data chunk into BitCode and return as image."""
-    data_encoded = rs.encode(data)
+def process_chunk(data, codec):
+    """Reed-Solomon encode a data chunk into the bytes of one frame behind a
+    4-byte length prefix; only the metadata frame still uses this layout."""
+    data_encoded = codec.encode(data)
     length = len(data_encoded)
 
-    length_encoded = rs.encode(length.to_bytes(4, "big"))
-
-    data = length_encoded + data_encoded
+    length_encoded = codec.encode(length.to_bytes(4, "big"))
+
+    return length_encoded + data_encoded
+
+
+def encode_chunk(data):
+    """RS-encode a chunk, reusing this worker's encoding of an identical
+    chunk if it is still cached."""
+    if cache is None:
+        return rs.encode(data)
+    key = chunk_digest(data)
+    encoded = cache.get(key)
+    if encoded is None:
+        encoded = rs.encode(data)
+        cache.put(key, encoded)
+    return encoded
+
+
+def process_group(spans, slots):
+    """Encode the chunks at the (offset, length) spans of the worker's mapped
+    source, interleave their codewords, append the task's parity frames and
+    rasterize each frame, header first, into its slot of the frame ring."""
+    payloads = []
+    for start in range(0, len(spans), interleave_depth):
+        group = [
+            encode_chunk(read_source(offset, length))
+            for offset, length in spans[start : start + interleave_depth]
+        ]
+        if len(group) > 1:
+            group = interleave(group)
+        payloads.extend(group)
+
+    frames = [
+        pack_header(DATA, offset // chunk_size, offset, payload, rs) + payload
+        for (offset, _), payload in zip(spans, payloads)
+    ]
+    if parity_frames:
+        capacity = frame_capacity(grid_size, calibrated, modulation)
+        capacity -= header_length(reedEC)
+        first_parity = spans[0][0] // chunk_size // task_size * parity_frames
+        parity = encode_parity(payloads, parity_frames, capacity)
+        for index, payload in enumerate(parity, first_parity):
+            frames.append(pack_header(PARITY, index, 0, payload, rs) + payload)
+
+    for data, slot in zip(frames, slots):
+        rasterize(data, ring[slot])
+    return slots
+
+
+def rasterize(data, out):
+    """Encode a data, parity or run frame's bytes into a ring slot."""
+    if whitening is not None:
+        capacity = frame_capacity(grid_size, calibrated, modulation)
+        data = whiten(data, whitening, capacity)
+    encode_to_luma(data, grid_size, resolution, out, calibrated, modulation, block)
+
+
+def process_run(run, slots):
+    """Rasterize the frame standing in for a run of tasks into every slot.
+
+    Parity frames do not cover run frames, so a run frame is repeated as
+    often as a task can lose frames, plus one; the decoder drops repeats.
+    """
+    payload = pack_run(run, rs)
+    data = pack_header(RUN, run.first, run.first * chunk_size, payload, rs) + payload
+    rasterize(data, ring[slots[0]])
+    for slot in slots[1:]:
+        ring[slot][...] = ring[slots[0]]
+    return slots
+
+
+def process_task(task, slots):
+    """process_group or process_run, whichever the reader made of a task."""
+    if isinstance(task, Run):
+        return process_run(task, slots)
+    return process_group(task, slots)
+
+
+def task_slots(task):
+    """Number of ring slots, i.e. frames, a task turns into."""
+    if isinstance(task, Run):
+        return 1 + parity_frames
+    return len(task) + parity_frames
+
+
+def write_metadata(meta_data, stream, container):
+    """Encode the metadata frame and write it to the video container.
+
+    It always uses the default EC and the default grid for the frame size,
+    whose cells stay as large as at the default resolution, so the decoder
+    can read it before it knows the parameters of the data frames.
+    """
+    data = json.dumps(meta_data, indent=4).encode("utf-8")
+    frame = process_chunk(data, RSCodec(nsym=global_reedEC, nsize=global_reedN))
+    grid = default_grid(resolution)
+    if len(frame) > frame_capacity(grid, calibrated):
+        raise ValueError("frame is too small to hold the metadata frame")
+    encode_to_luma(frame, grid, resolution, frame_buffer, calibrated)
+    write_frame(frame_buffer, stream, container)
+
+
+def open_stream(dest, threads=None):
+    """Open an output container with an H.264 stream for our frames."""
+    container = av.open(dest, mode="w")
+    stream = container.add_stream("h264", rate=frame_rate)
+    stream.height, stream.width = plane_shape(resolution)
+    stream.pix_fmt = "yuv420p"
+    stream.options = {"crf": str(crf), "g": str(keyframe_interval)}
+    if threads:
+        stream.options["threads"] = str(threads)
+    return container, stream
 
-    return encode_to_image(data, grid_size, width_height)
 
+def close_stream(stream, container):
+    """Flush the encoder and finalize the video file."""
+    for packet in stream.encode():
+        container.mux(packet)
+    container.close()
 
-def encode_and_write_frames(frames, stream, container):
-    """Encode frames and write to video container."""
-    for frame in frames:
-        video_frame = av.VideoFrame.from_ndarray(frame, format="rgb24")
-        for packet in stream.encode(video_frame):
-            container.mux(packet)
 
+def write_frame(image, stream, container):
+    """Encode one yuv420p frame buffer and mux its packets."""
+    video_frame = av.VideoFrame.from_ndarray(image, format="yuv420p")
+    for packet in stream.encode(video_frame):
+        container.mux(packet)
 
-def create_video(src, dest, reedEC, grid_size, read_file_lazy=False):
-    """Create video from source file using PyAV."""
 
-    globals()["grid_size"] = grid_size
-    globals()["rs"] = RSCodec(nsym=reedEC, nsize=global_reedN)
+def iter_groups(file_size, chunk_size, depth, first=0):
+    """Yield lists of up to depth (offset, length) descriptors covering the
+    source file from offset first on, one list per worker task."""
+    group_size = chunk_size * depth
+    for start in range(first, file_size, group_size):
+        end = min(start + group_size, file_size)
+        yield [
+            (offset, min(chunk_size, end - offset))
+            for offset in range(start, end, chunk_size)
+        ]
+
+
+def find_runs(groups, mapped):
+    """Replace runs of whole tasks whose chunks are all zeros, or all repeat
+    the chunk just before the run, by a Run each.
+
+    Hashes every chunk of mapped, the open_source of the source; other groups
+    pass through.
+    """
+    zero = chunk_digest(bytes(chunk_size))
+    previous = None
+    run = None
+    for group in groups:
+        digests = [chunk_digest(read_span(mapped, *span)) for span in group]
+        first = group[0][0] // chunk_size
+        uniform = (
+            len(group) == task_size
+            and group[-1][1] == chunk_size
+            and digests.count(digests[0]) == len(digests)
+        )
+        run_source = None
+        if uniform and digests[0] == zero:
+            run_source = -1
+        elif uniform and previous is not None and digests[0] == previous[0]:
+            run_source = previous[1]
+
+        if run is not None and (run_source, first) != (
+            run.source,
+            run.first + run.count,
+        ):
+            yield run
+            run = None
+        if run_source is None:
+            yield group
+            previous = (digests[-1], first + len(group) - 1)
+            continue
+        if run is None:
+            run = Run(first, len(group), run_source)
+        else:
+            run = run._replace(count=run.count + len(group))
+        previous = (digests[0], run_source)
+    if run is not None:
+        yield run
+
+
+def read_stage(groups, out):
+    """Reader: push chunk descriptors into the bounded chunk queue."""
+    for group in groups:
+        out.put(group)
+    out.put(DONE)
+
+
+def dispatch_stage(pool, chunks, free_slots, out):
+    """Hand chunk descriptors to the RS workers, queueing results in order.
+
+    Every chunk needs a free frame ring slot before it is dispatched, and the
+    bounded result queue caps how many chunks are in flight, so memory stays
+    flat however large the source is.
+    """
+    while True:
+        group = chunks.get()
+        if group is DONE:
+            break
+        slots = [free_slots.get() for _ in range(task_slots(group))]
+        out.put(pool.apply_async(process_task, (group, slots)))
+    out.put(DONE)
 
-    reedK = global_reedN - reedEC
 
-    chunk_size = (reedK * ((grid_size * grid_size) // (global_reedN * 8))) - (
-        4 + reedEC
+def encode_stage(results, free_slots, stream, container, pbar):
+    """Encoder/mux: take rendered ring slots in submission order, encode them
+    and hand each slot back as soon as the encoder has copied it."""
+    while True:
+        result = results.get()
+        if result is DONE:
+            break
+        for slot in results.wait(result):
+            write_frame(ring[slot], stream, container)
+            free_slots.put(slot)
+            pbar.update(1)
+
+
+def encode_segment(segment):
+    """Encode the worker tasks of one byte range into their own container.
+
+    Runs in a segment process, which does the RS encoding, rasterizing and
+    H.264 encoding of its range serially; segment is (part, first, end,
+    threads, meta_data), where only the first segment carries meta_data.
+    Returns the number of frames written.
+    """
+    part, first, end, threads, meta_data = segment
+    task_frames = task_size + parity_frames
+    globals()["ring"] = np.empty((task_frames,) + frame_buffer.shape, dtype=np.uint8)
+    ring[:, plane_shape(resolution)[0] :] = 128
+    slots = list(range(task_frames))
+
+    container, stream = open_stream(part, threads)
+    frames = 0
+    if meta_data is not None:
+        write_metadata(meta_data, stream, container)
+        frames += 1
+    groups = iter_groups(end, chunk_size, task_size, first)
+    if runs:
+        groups = find_runs(groups, source)
+    for group in groups:
+        for slot in process_task(group, slots[: task_slots(group)]):
+            write_frame(ring[slot], stream, container)
+            frames += 1
+    close_stream(stream, container)
+    return frames
+
+
+def encode_segments(src, dest, meta_data, segments, keep_parts, pbar):
+    """Encode contiguous ranges of the source in parallel, one segment process
+    and PyAV container each, then join the parts with a stream copy, or keep
+    them as a numbered set described by a manifest."""
+    file_size = meta_data["FileSize:"]
+    task_bytes = chunk_size * task_size
+    tasks_per_segment = math.ceil(math.ceil(file_size / task_bytes) / segments)
+    segment_bytes = max(1, tasks_per_segment) * task_bytes
+    bounds = list(range(0, file_size, segment_bytes)) or [0]
+    parts = part_paths(dest, len(bounds))
+    threads = max(1, cpu_count() // len(bounds))
+    jobs = [
+        (
+            part,
+            first,
+            min(first + segment_bytes, file_size),
+            threads,
+            meta_data if first == 0 else None,
+        )
+        for part, first in zip(parts, bounds)
+    ]
+
+    with Pool(len(jobs), initializer=map_source, initargs=(src,)) as pool:
+        frames = []
+        for count in pool.imap(encode_segment, jobs):
+            frames.append(count)
+            pbar.update(count)
+
+    if keep_parts:
+        write_manifest(dest, parts, frames)
+    else:
+        concat_parts(parts, dest)
+        for part in parts:
+            os.remove(part)
+
+
+def encode_chunks(pool, groups, stream, container, pbar, queue_depth):
+    """Run the reader, dispatch and encoder stages over groups and return
+    their queues for reporting."""
+    abort = threading.Event()
+    chunks = StageQueue("chunks", queue_depth, abort)
+    results = StageQueue("frames", queue_depth, abort)
+    free_slots = StageQueue("slots", ring.slots, abort)
+    for slot in range(ring.slots):
+        free_slots.put(slot)
+
+    run_stages(
+        [
+            Stage("reader", read_stage, abort, groups, chunks),
+            Stage(
+                "dispatch", dispatch_stage, abort, pool, chunks, free_slots, results
+            ),
+            Stage(
+                "encoder",
+                encode_stage,
+                abort,
+                results,
+                free_slots,
+                stream,
+                container,
+                pbar,
+            ),
+        ]
     )
+    return [chunks, free_slots, results]
+
+
+def macroblock_cells(resolution, grid_size):
+    """Cells per side of a 16x16 pixel H.264 macroblock, for grids whose
+    cells are square and tile macroblocks exactly."""
+    height, width = plane_shape(resolution)
+    rows, cols = plane_shape(grid_size)
+    cell = height // rows
+    if height % rows or width % cols or width // cols != cell or 16 % cell:
+        raise ValueError(
+            "the macroblock layout needs square cells of 1, 2, 4, 8 or 16 pixels"
+        )
+    return 16 // cell
+
+
+def create_video(
+    src,
+    dest,
+    reedEC,
+    grid_size,
+    interleave_depth=1,
+    parity_group=0,
+    parity_frames=0,
+    segments=1,
+    keep_parts=False,
+    queue_depth=None,
+    stats=False,
+    keyframe_interval=default_keyframe_interval,
+    compression=None,
+    compress_block_size=default_block_size,
+    runs=False,
+    cache_bytes=default_cache_bytes,
+    calibration=True,
+    modulation="binary",
+    crf=None,
+    resolution=default_resolution,
+    macroblock_layout=False,
+    whitening=None,
+):
+    """Create video from source file using PyAV.
+
+    src, a file or a directory packed as an archive, becomes a metadata
+    frame recording the encoding parameters followed by its RS-encoded
+    data frames. The options are described by file2video.py --help and the
+    modules implementing them. Raises ValueError for options that cannot
+    produce a decodable video.
+    """
+
+    if interleave_depth < 1:
+        raise ValueError("interleave depth must be at least 1")
+    if parity_frames and (parity_group <= 0 or parity_group % interleave_depth):
+        raise ValueError("parity group must be a multiple of the interleave depth")
+    if parity_group + parity_frames > 256:
+        raise ValueError("parity group plus parity frames must not exceed 256")
+    task_size = parity_group if parity_frames else interleave_depth
+    height, width = plane_shape(resolution)
+    if width % 2 or height % 2:
+        raise ValueError("frame width and height must be even for yuv420p")
+    rows, cols = plane_shape(grid_size)
+    if rows > height or cols > width:
+        raise ValueError("grid must not have more cells than the frame has pixels")
+    reedK = global_reedN - reedEC
+    codewords = frame_capacity(grid_size, calibration, modulation) // global_reedN
+    chunk_size = reedK * codewords - header_length(reedEC)
+    if chunk_size <= 0:
+        raise ValueError("grid is too small to hold a frame header and any data")
 
-    file_stats = os.stat(src)
-    file_size = file_stats.st_size
-    chunk_count = math.ceil(file_size / chunk_size)
-    print("chunk count:", chunk_count)
-
-    pbar = tqdm(total=chunk_count, desc="Generating Frames")
+    globals()["grid_size"] = grid_size
+    globals()["resolution"] = resolution
+    globals()["reedEC"] = reedEC
+    globals()["interleave_depth"] = interleave_depth
+    globals()["parity_frames"] = parity_frames
+    globals()["task_size"] = task_size
+    globals()["keyframe_interval"] = keyframe_interval
+    globals()["compression"] = compression
+    globals()["runs"] = runs
+    globals()["calibrated"] = calibration
+    globals()["modulation"] = modulation
+    globals()["crf"] = default_crf[modulation] if crf is None else crf
+    block = macroblock_cells(resolution, grid_size) if macroblock_layout else 1
+    globals()["block"] = block
+    globals()["whitening"] = whitening
+    globals()["cache"] = ChunkCache(cache_bytes) if cache_bytes else None
+    globals()["rs"] = RSCodec(nsym=reedEC, nsize=global_reedN)
+    globals()["frame_buffer"] = new_yuv420_frame(width, height)
+    globals()["chunk_size"] = chunk_size
+
+    filename = os.path.basename(os.path.normpath(src))
+    if os.path.isdir(src):
+        # Pack the directory's files behind an index into one stream.
+        src = Archive(src)
+        file_size = src.size
+    else:
+        file_stats = os.stat(src)
+        file_size = file_stats.st_size
+
+    packed = None
+    if compression:
+        packed = compress_source(src, file_size, dest, compress_block_size)
 
     meta_data = {
-        "Filename": os.path.basename(src),
-        "ChunkCount": chunk_count,
-        "FileSize:": file_size,
+        "Filename": filename,
+        "ChunkSize": chunk_size,
+        "ReedEC": reedEC,
+        "GridSize": grid_size if np.ndim(grid_size) == 0 else list(grid_size),
+        "Interleave": interleave_depth,
+        "ParityGroup": parity_group,
+        "ParityFrames": parity_frames,
+        "KeyframeInterval": keyframe_interval,
+        "Version": FORMAT_VERSION,
     }
+    if isinstance(src, Archive):
+        meta_data["IndexSize"] = len(src.index)
+    if runs:
+        meta_data["Runs"] = True
+    if calibration:
+        meta_data["Calibration"] = True
+    if modulation != "binary":
+        meta_data["Modulation"] = modulation
+    if block > 1:
+        meta_data["MacroblockCells"] = block
+    if whitening is not None:
+        meta_data["Whitening"] = whitening
+    if packed is not None:
+        src, file_size, stream_meta = packed
+        meta_data.update(stream_meta)
 
-    first_frame_data = json.dumps(meta_data, indent=4)
-    first_frame = process_chunk(first_frame_data.encode("utf-8"))
+    chunk_count = math.ceil(file_size / chunk_size)
+    print("chunk count:", chunk_count)
+    meta_data["ChunkCount"] = chunk_count
+    meta_data["FileSize:"] = file_size
+
+    try:
+        write_video(src, dest, meta_data, segments, keep_parts, queue_depth, stats)
+    finally:
+        if packed is not None:
+            os.remove(src)
+
+
+def write_video(src, dest, meta_data, segments, keep_parts, queue_depth, stats):
+    """Encode the chunk stream of src, after the metadata frame, into dest.
+
+    The reader, RS workers and H.264 encoder are joined by queues of
+    queue_depth tasks, by default as many as make up twice the worker count
+    in frames; stats prints how long each stage stalled on them. segments > 1 encodes that many parts in
+    parallel instead, joined unless keep_parts.
+    """
+    file_size = meta_data["FileSize:"]
+    chunk_count = meta_data["ChunkCount"]
+    frame_count = chunk_count + math.ceil(chunk_count / task_size) * parity_frames
+    pbar = tqdm(total=frame_count, desc="Generating Frames")
+
+    if segments > 1:
+        encode_segments(src, dest, meta_data, segments, keep_parts, pbar)
+        pbar.close()
+        return
 
     # Open output file
-    container = av.open(dest, mode="w")
-    stream = container.add_stream("h264", rate=frame_rate)
-    stream.width = width_height
-    stream.height = width_height
-    stream.pix_fmt = "yuv420p"
-    stream.options = {"crf": "40"}
+    container, stream = open_stream(dest)
 
     # Write the first frame
-    video_frame = av.VideoFrame.from_ndarray(first_frame, format="rgb24")
-    for packet in stream.encode(video_frame):
-        container.mux(packet)
-
-    # Process chunks in batches using multiprocessing
-    with open(src, "rb") as f, Pool(cpu_count()) as pool:
-        entire_file = []
-        if not read_file_lazy:
-            entire_file = f.read()
-        i = 0
-        while True:
-
-            chunks = []
-
-            if read_file_lazy:
-                chunks = list(islice(read_in_chunks(f, chunk_size), cpu_count()))
-            else:
-                for _ in range(cpu_count()):
-                    chunks.append(entire_file[i : i + chunk_size])
-                    if not chunks[-1]:  # empty
-                        chunks.pop()
-                        break
-                    i = i + chunk_size
-            if not chunks:
-                break
-
-            frames = pool.map(process_chunk, chunks)
-            encode_and_write_frames(frames, stream, container)
-            pbar.update(len(frames))
+    write_metadata(meta_data, stream, container)
+
+    num_workers = cpu_count()
+    task_frames = task_size + parity_frames
+    if queue_depth is None:
+        # Bound the frame ring by frames, not tasks; a task may be hundreds.
+        queue_depth = max(1, 2 * num_workers // task_frames)
+
+    # One group of slots per in-flight group plus one being encoded; created
+    # before the pool so the forked workers share it.
+    slots = (queue_depth + 1) * task_frames
+    globals()["ring"] = FrameRing(slots, frame_buffer.shape)
+    ring.frames[:, plane_shape(resolution)[0] :] = 128
+
+    start = time.perf_counter()
+    mapped = None
+    try:
+        with Pool(num_workers, initializer=map_source, initargs=(src,)) as pool:
+            groups = iter_groups(file_size, chunk_size, task_size)
+            if runs:
+                # The reader hashes the chunks itself to find the runs.
+                mapped = open_source(src)
+                groups = find_runs(groups, mapped)
+            queues = encode_chunks(pool, groups, stream, container, pbar, queue_depth)
+    finally:
+        ring.close()
+        close_source(mapped)
 
     pbar.close()
 
     # Finalize the video file
-    for packet in stream.encode():
-        container.mux(packet)
-    container.close()
+    close_stream(stream, container)
+
+    if stats:
+        print(format_report(queues, time.perf_counter() - start))
 
 
 if __name__ == "__main__":
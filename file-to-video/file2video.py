@@ -1,18 +1,69 @@
-from encode import create_video
-from decode_video import decode
+from encode import (
+    create_video,
+    default_grid,
+    default_keyframe_interval,
+    default_resolution,
+)
+from compress import CODECS, default_codec
+from chunkcache import default_cache_bytes
+from decode_video import decode, decode_range, extract_file, repair
+from v2 import MODULATIONS
+from whiten import default_key
 import argparse
 
 from common import *
 
 
-def enc_file(source_file, output_video):
+def enc_file(
+    source_file,
+    output_video,
+    reed_ec=global_reedEC,
+    grid_size=global_gridSize,
+    **options,
+):
     print(f"Encoding {source_file} to {output_video}")
-    create_video(source_file, output_video, global_reedEC, global_gridSize)
+    create_video(source_file, output_video, reed_ec, grid_size, **options)
 
 
-def dec_video(source_video, destination_folder):
+def parse_size(text):
+    """A side length, e.g. 1080, or WIDTHxHEIGHT, e.g. 1920x1080."""
+    width, _, height = text.lower().partition("x")
+    if not height:
+        return int(width)
+    return (int(width), int(height))
+
+
+def dec_video(source_video, destination_folder, partial=False, copies=()):
     print(f"Decoding {source_video} to {destination_folder}")
-    decode(source_video, destination_folder, global_reedEC, global_gridSize)
+    decode(
+        source_video,
+        destination_folder,
+        global_reedEC,
+        global_gridSize,
+        partial,
+        copies,
+    )
+
+
+def rep_output(source_video, destination_folder, copies=()):
+    print(f"Repairing {destination_folder} from {source_video}")
+    repair(source_video, destination_folder, global_reedEC, global_gridSize, copies)
+
+
+def dec_range(source_video, offset, length, output_file):
+    print(f"Decoding {length} bytes at {offset} of {source_video} to {output_file}")
+    data = decode_range(
+        source_video, int(offset), int(length), global_reedEC, global_gridSize
+    )
+    with open(output_file, "wb") as f:
+        f.write(data)
+
+
+def ext_file(source_video, name, destination_folder):
+    print(f"Extracting {name} from {source_video} to {destination_folder}")
+    extract_file(
+        source_video, name, destination_folder, global_reedEC, global_gridSize
+    )
 
 
 def main():
@@ -26,7 +77,8 @@ def main():
         "--encode",
         nargs=2,
         metavar=("source_file", "output_video"),
-        help="Encode a file into a video: source_file output_video.mp4",
+        help="Encode a file, or a directory as an archive, into a video: "
+        "source_file output_video.mp4",
     )
 
     # Optional argument for decoding
@@ -37,6 +89,30 @@ def main():
         help="Decode a video to a file: source_video.mp4 destination_folder",
     )
 
+    parser.add_argument(
+        "--decode-range",
+        nargs=4,
+        metavar=("source_video", "offset", "length", "output_file"),
+        help="Decode only length bytes at offset of the encoded file, seeking "
+        "to the nearest keyframe: source_video.mp4 offset length output_file",
+    )
+
+    parser.add_argument(
+        "--repair",
+        nargs=2,
+        metavar=("source_video", "destination_folder"),
+        help="Re-decode the damaged ranges of a --partial decode from the same "
+        "video or another copy: source_video.mp4 destination_folder",
+    )
+
+    parser.add_argument(
+        "--extract",
+        nargs=3,
+        metavar=("source_video", "name", "destination_folder"),
+        help="Extract one file of an archive video by its path in the archive: "
+        "source_video.mp4 name destination_folder",
+    )
+
     # Optional argument for YouTube video decoding
     parser.add_argument(
         "--youtube-decode",
@@ -45,13 +121,201 @@ def main():
         help="Decode a video from a YouTube URL to a file: 'youtube_url' destination_folder",
     )
 
+    parser.add_argument(
+        "--partial",
+        action="store_true",
+        help="Leave chunks that cannot be decoded as zeros and record them in "
+        "a .damage.json next to the output instead of failing (decoding only)",
+    )
+
+    parser.add_argument(
+        "--copy",
+        dest="copies",
+        action="append",
+        default=[],
+        metavar="VIDEO",
+        help="Another copy of the same video, e.g. a different download or "
+        "re-encode, whose frames are combined with the source's where it "
+        "does not decode on its own; repeatable (decoding and repair only)",
+    )
+
+    parser.add_argument(
+        "--reed-ec",
+        type=int,
+        default=global_reedEC,
+        help="Reed-Solomon parity symbols per 255-byte codeword (encoding only)",
+    )
+
+    parser.add_argument(
+        "--interleave",
+        type=int,
+        default=1,
+        metavar="D",
+        help="Interleave RS codewords across D consecutive frames, so a lost "
+        "frame costs each codeword at most 255/D bytes (encoding only)",
+    )
+
+    parser.add_argument(
+        "--parity",
+        type=int,
+        nargs=2,
+        default=(0, 0),
+        metavar=("G", "P"),
+        help="Add P parity frames after every G data frames, a multiple of D, "
+        "from which up to P lost frames of the G are rebuilt (encoding only)",
+    )
+
+    parser.add_argument(
+        "--segments",
+        type=int,
+        default=1,
+        metavar="N",
+        help="Encode N segments in parallel and join them (encoding only)",
+    )
+
+    parser.add_argument(
+        "--keep-parts",
+        action="store_true",
+        help="Keep the segments as numbered parts plus a manifest instead of "
+        "joining them; decode by passing the .manifest.json",
+    )
+
+    parser.add_argument(
+        "--keyframe-interval",
+        type=int,
+        default=default_keyframe_interval,
+        metavar="N",
+        help="Frames between keyframes; smaller makes --decode-range seek "
+        "faster at some cost in size (encoding only)",
+    )
+
+    parser.add_argument(
+        "--compress",
+        nargs="?",
+        const=default_codec(),
+        choices=sorted(CODECS),
+        metavar="CODEC",
+        help="Compress the file in independent blocks before encoding unless it "
+        f"looks incompressible: {', '.join(sorted(CODECS))} (default "
+        f"{default_codec()}) (encoding only)",
+    )
+
+    parser.add_argument(
+        "--runs",
+        action="store_true",
+        help="Write runs of whole tasks that are all zeros, or all repeat the "
+        "chunk just before the run, as a run frame each, repeated once per "
+        "parity frame (encoding only)",
+    )
+
+    parser.add_argument(
+        "--cache-mb",
+        type=int,
+        default=default_cache_bytes >> 20,
+        metavar="MB",
+        help="Per-worker cache of RS-encoded chunks for repeated data, 0 to "
+        "disable (encoding only)",
+    )
+
+    parser.add_argument(
+        "--no-calibration",
+        dest="calibration",
+        action="store_false",
+        help="Leave out the black and white reference cells the decoder "
+        "thresholds each frame against (encoding only)",
+    )
+
+    parser.add_argument(
+        "--modulation",
+        choices=list(MODULATIONS),
+        default="binary",
+        help="Bits per cell: binary (1), gray4 (2, four luma levels), chroma "
+        "(1 plus a bit per U and V cell) or gray4-chroma (encoding only)",
+    )
+
+    parser.add_argument(
+        "--crf",
+        type=int,
+        help="H.264 crf, lower keeping cell levels apart better at the cost "
+        "of a larger video (default: 40, or 30 for gray4 modulations) "
+        "(encoding only)",
+    )
+
+    parser.add_argument(
+        "--resolution",
+        type=parse_size,
+        default=default_resolution,
+        metavar="WxH",
+        help="Frame size, e.g. 1920x1080, or a side length for square frames "
+        "(default 1080) (encoding only)",
+    )
+
+    parser.add_argument(
+        "--grid",
+        type=parse_size,
+        metavar="WxH",
+        help="Cells across and down the frame (default: 4x4 pixel cells, "
+        "e.g. 480x270 at 1920x1080) (encoding only)",
+    )
+
+    parser.add_argument(
+        "--macroblock-layout",
+        action="store_true",
+        help="Lay bits out one H.264 macroblock at a time, keeping damage to "
+        "a macroblock within few bytes; needs cells of 1, 2, 4, 8 or 16 "
+        "pixels (encoding only)",
+    )
+
+    parser.add_argument(
+        "--whiten",
+        nargs="?",
+        type=int,
+        const=default_key,
+        metavar="KEY",
+        help="XOR every frame with a pseudo-random mask from KEY (default "
+        f"{default_key}) so structured data looks like noise to the codec "
+        "(encoding only)",
+    )
+
+    parser.add_argument(
+        "--stats",
+        action="store_true",
+        help="Print per-stage queue depth and stall times after encoding",
+    )
+
     args = parser.parse_args()
 
     # Check which command is used and call the corresponding function
     if args.encode:
-        enc_file(*args.encode)
+        enc_file(
+            *args.encode,
+            reed_ec=args.reed_ec,
+            interleave_depth=args.interleave,
+            parity_group=args.parity[0],
+            parity_frames=args.parity[1],
+            segments=args.segments,
+            keep_parts=args.keep_parts,
+            stats=args.stats,
+            keyframe_interval=args.keyframe_interval,
+            compression=args.compress,
+            runs=args.runs,
+            cache_bytes=args.cache_mb << 20,
+            calibration=args.calibration,
+            modulation=args.modulation,
+            crf=args.crf,
+            resolution=args.resolution,
+            macroblock_layout=args.macroblock_layout,
+            whitening=args.whiten,
+            grid_size=args.grid or default_grid(args.resolution),
+        )
     elif args.decode:
-        dec_video(*args.decode)
+        dec_video(*args.decode, partial=args.partial, copies=args.copies)
+    elif args.repair:
+        rep_output(*args.repair, copies=args.copies)
+    elif args.decode_range:
+        dec_range(*args.decode_range)
+    elif args.extract:
+        ext_file(*args.extract)
     else:
         parser.print_help()
 
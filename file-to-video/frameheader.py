@@ -0,0 +1,64 @@
+"""Per-frame header carrying the frame's position and payload checksum.
+
+Every data and parity frame starts with one Reed-Solomon codeword holding
+the frame kind, its index (chunk index for data frames, parity frame number
+for parity frames), the byte offset of its chunk in the source file, the
+payload length and the CRC32 of the payload as rasterized. The decoder
+reads it without touching the payload, so it can place frames regardless
+of their order in the video, drop duplicates and check a payload before
+deciding whether it needs RS decoding at all.
+
+A run frame stands in for a run of whole tasks whose chunks are all zeros
+or all repeat one earlier chunk. Its index is the run's first chunk and
+its RS-encoded payload holds the run's chunk count and source chunk, -1
+for zeros.
+"""
+
+import struct
+import zlib
+from collections import namedtuple
+
+# Metadata "Version" of videos whose frames carry this header. Videos
+# without the key use the original 4-byte length prefix instead.
+FORMAT_VERSION = 2
+
+DATA = 0
+PARITY = 1
+RUN = 2
+
+HEADER = struct.Struct(">BIQII")
+RUN_PAYLOAD = struct.Struct(">Iq")
+
+FrameHeader = namedtuple("FrameHeader", "kind index offset length crc")
+Run = namedtuple("Run", "first count source")
+
+
+def header_length(reedEC):
+    """Bytes the RS-encoded header takes at the start of a frame."""
+    return HEADER.size + reedEC
+
+
+def pack_header(kind, index, offset, payload, rs):
+    """RS-encoded header for a frame whose payload follows it."""
+    crc = zlib.crc32(payload)
+    return rs.encode(HEADER.pack(kind, index, offset, len(payload), crc))
+
+
+def unpack_header(data, rs):
+    """Decode the header at the start of a frame's bytes.
+
+    Raises reedsolo.ReedSolomonError if the header is unreadable.
+    """
+    header, _, _ = rs.decode(data[: header_length(rs.nsym)])
+    return FrameHeader(*HEADER.unpack(bytes(header)))
+
+
+def pack_run(run, rs):
+    """RS-encoded payload of a run frame."""
+    return rs.encode(RUN_PAYLOAD.pack(run.count, run.source))
+
+
+def unpack_run(first, data):
+    """Run described by the decoded payload of a run frame."""
+    count, source = RUN_PAYLOAD.unpack(bytes(data[: RUN_PAYLOAD.size]))
+    return Run(first, count, source)
@@ -0,0 +1,32 @@
+"""Shared-memory ring of frame slots for passing frames between processes."""
+
+from multiprocessing import shared_memory
+
+import numpy as np
+
+
+class FrameRing:
+    """A fixed number of same-shaped uint8 frames in one shared memory block.
+
+    Create the ring before forking the worker pool; the workers inherit the
+    mapping, so a frame written into a slot on one side is visible on the
+    other without pickling. Only slot indices travel through the pool.
+    """
+
+    def __init__(self, slots, shape):
+        self.slots = slots
+        self.shape = tuple(shape)
+        size = slots * int(np.prod(self.shape))
+        self.shm = shared_memory.SharedMemory(create=True, size=max(size, 1))
+        self.frames = np.ndarray(
+            (slots,) + self.shape, dtype=np.uint8, buffer=self.shm.buf
+        )
+
+    def __getitem__(self, slot):
+        return self.frames[slot]
+
+    def close(self):
+        """Release the mapping and remove the shared memory block."""
+        del self.frames
+        self.shm.close()
+        self.shm.unlink()
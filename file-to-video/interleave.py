@@ -0,0 +1,69 @@
+"""Spread Reed-Solomon codewords across a group of consecutive frames.
+
+A frame's payload is its RS-encoded chunk, i.e. a run of codewords of at
+most global_reedN symbols. Interleaving a group of D payloads emits symbol
+0 of every codeword in the group, then symbol 1 of every codeword, and so
+on, and cuts that stream back into payloads of the original lengths. Symbol
+j of each codeword therefore lands in frame ~j * D / 255, so losing one
+frame costs any codeword at most ceil(255 / D) symbols, and neighbouring
+bytes on screen belong to different codewords. Frame headers are not
+interleaved, so every frame can still be identified on its own.
+"""
+
+import math
+from functools import lru_cache
+
+import numpy as np
+
+from common import *
+
+
+def encoded_length(chunk_length, reedEC):
+    """Byte length of a chunk after RS encoding."""
+    reedK = global_reedN - reedEC
+    return chunk_length + math.ceil(chunk_length / reedK) * reedEC
+
+
+def codeword_lengths(payload_lengths):
+    """Lengths of the codewords making up a group of payloads, in order."""
+    lengths = []
+    for length in payload_lengths:
+        lengths.extend([global_reedN] * (length // global_reedN))
+        if length % global_reedN:
+            lengths.append(length % global_reedN)
+    return lengths
+
+
+@lru_cache(maxsize=8)
+def interleave_order(payload_lengths):
+    """Index array mapping interleaved positions to group stream positions."""
+    lengths = np.array(codeword_lengths(payload_lengths))
+    starts = np.concatenate(([0], np.cumsum(lengths)[:-1]))
+    symbol = np.arange(lengths.max())[:, None]
+    # Row j holds symbol j of every codeword long enough to have one, so
+    # reading the rows in order goes codeword by codeword for each symbol.
+    return (starts + symbol)[lengths > symbol]
+
+
+def interleave(payloads):
+    """Interleave the RS codewords of a group of frame payloads."""
+    lengths = tuple(len(payload) for payload in payloads)
+    stream = np.frombuffer(b"".join(payloads), dtype=np.uint8)
+    return split_frames(stream[interleave_order(lengths)], lengths)
+
+
+def deinterleave(payloads, payload_lengths):
+    """Undo interleave on sampled payloads, each at least as long as expected."""
+    lengths = tuple(payload_lengths)
+    out = np.concatenate(
+        [np.frombuffer(p, dtype=np.uint8)[:n] for p, n in zip(payloads, lengths)]
+    )
+    stream = np.empty_like(out)
+    stream[interleave_order(lengths)] = out
+    return split_frames(stream, lengths)
+
+
+def split_frames(stream, lengths):
+    """Cut a byte stream into bytearrays of the given lengths."""
+    bounds = np.cumsum(lengths)[:-1]
+    return [bytearray(part) for part in np.split(stream, bounds)]
@@ -0,0 +1,118 @@
+"""Erasure-code parity frames over groups of data frames.
+
+Byte b of the P parity frames of a group is the Reed-Solomon (Cauchy
+matrix) parity of byte b of the group's G data frames over GF(256), so any
+G of the G + P frames are enough to rebuild the others. Rows are whole
+frame payloads padded with zeros to the grid's byte capacity, and the
+arithmetic is vectorized across them with a full multiplication table.
+"""
+
+import numpy as np
+
+# GF(256) with the primitive polynomial reedsolo uses by default.
+gf_exp = np.zeros(512, dtype=np.uint8)
+gf_log = np.zeros(256, dtype=np.int64)
+_x = 1
+for _i in range(255):
+    gf_exp[_i] = _x
+    gf_log[_x] = _i
+    _x <<= 1
+    if _x & 0x100:
+        _x ^= 0x11D
+gf_exp[255:510] = gf_exp[:255]
+
+_nonzero = np.arange(1, 256)
+gf_mul_table = np.zeros((256, 256), dtype=np.uint8)
+gf_mul_table[1:, 1:] = gf_exp[gf_log[_nonzero][:, None] + gf_log[_nonzero][None, :]]
+
+
+def gf_inverse(x):
+    return int(gf_exp[255 - gf_log[x]])
+
+
+def cauchy_matrix(parity_frames, data_frames):
+    """P x G matrix whose every square submatrix is invertible."""
+    return np.array(
+        [
+            [gf_inverse((data_frames + p) ^ g) for g in range(data_frames)]
+            for p in range(parity_frames)
+        ],
+        dtype=np.uint8,
+    )
+
+
+def gf_matmul(matrix, rows):
+    """Multiply a small coefficient matrix by a stack of byte rows."""
+    out = np.zeros((matrix.shape[0], rows.shape[1]), dtype=np.uint8)
+    for i, coefficients in enumerate(matrix):
+        for coefficient, row in zip(coefficients, rows):
+            if coefficient:
+                out[i] ^= gf_mul_table[coefficient][row]
+    return out
+
+
+def gf_invert(matrix):
+    """Invert a square matrix over GF(256) by Gauss-Jordan elimination."""
+    n = len(matrix)
+    a = [
+        [int(v) for v in row] + [int(i == j) for j in range(n)]
+        for i, row in enumerate(matrix)
+    ]
+    for col in range(n):
+        pivot = next(r for r in range(col, n) if a[r][col])
+        a[col], a[pivot] = a[pivot], a[col]
+        scale = gf_inverse(a[col][col])
+        a[col] = [int(gf_mul_table[scale][v]) for v in a[col]]
+        for r in range(n):
+            if r != col and a[r][col]:
+                factor = a[r][col]
+                a[r] = [
+                    v ^ int(gf_mul_table[factor][w]) for v, w in zip(a[r], a[col])
+                ]
+    return np.array([row[n:] for row in a], dtype=np.uint8)
+
+
+def to_rows(frames, capacity):
+    """Stack frame payloads into a zero-padded (len(frames), capacity) array."""
+    rows = np.zeros((len(frames), capacity), dtype=np.uint8)
+    for row, frame in zip(rows, frames):
+        data = np.frombuffer(frame, dtype=np.uint8)[:capacity]
+        row[: data.size] = data
+    return rows
+
+
+def encode_parity(frames, parity_frames, capacity):
+    """Parity frame payloads for a group of data frame payloads.
+
+    A group shorter than the configured size, e.g. at the end of the file,
+    gets the Cauchy matrix of its own size rather than a shortened code, and
+    recover_frames rebuilds it with the same matrix.
+    """
+    rows = to_rows(frames, capacity)
+    parity = gf_matmul(cauchy_matrix(parity_frames, len(frames)), rows)
+    return [bytes(row) for row in parity]
+
+
+def recover_frames(frames, erased, parity_frames, capacity):
+    """Rebuild the erased data frames of a group.
+
+    frames holds the group's data frame payloads followed by its parity frame
+    payloads; erased lists the indices of unusable frames, data or parity.
+    Returns the rebuilt data frame payloads in the order erased lists them.
+    """
+    data_frames = len(frames) - parity_frames
+    if len(erased) > parity_frames:
+        raise ValueError(
+            f"{len(erased)} frames lost in a group with {parity_frames} parity frames"
+        )
+    generator = np.vstack(
+        [
+            np.eye(data_frames, dtype=np.uint8),
+            cauchy_matrix(parity_frames, data_frames),
+        ]
+    )
+    survivors = [i for i in range(len(frames)) if i not in erased][:data_frames]
+    lost = [i for i in erased if i < data_frames]
+    decode_matrix = gf_invert(generator[survivors])[lost]
+    rows = to_rows([frames[i] for i in survivors], capacity)
+    return [bytes(row) for row in gf_matmul(decode_matrix, rows)]
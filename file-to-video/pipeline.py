@@ -0,0 +1,115 @@
+"""Bounded, instrumented queues and threads for the streaming encoder."""
+
+import queue
+import threading
+import time
+
+# Sentinel a stage puts on its output queue when it has no more items.
+DONE = object()
+
+
+class PipelineAborted(Exception):
+    """Raised inside a stage when another stage has already failed."""
+
+
+class StageQueue:
+    """Bounded FIFO between two pipeline stages.
+
+    Records how long producers blocked on a full queue (the consumer is the
+    bottleneck) and how long consumers blocked on an empty one (the producer
+    is), plus the depth seen by every get.
+    """
+
+    def __init__(self, name, maxsize, abort):
+        self.name = name
+        self.maxsize = maxsize
+        self.abort = abort
+        self.items = 0
+        self.put_stall = 0.0
+        self.get_stall = 0.0
+        self.depth_sum = 0
+        self.depth_max = 0
+        self._queue = queue.Queue(maxsize)
+
+    def put(self, item):
+        start = time.perf_counter()
+        while True:
+            try:
+                self._queue.put(item, timeout=0.1)
+                break
+            except queue.Full:
+                if self.abort.is_set():
+                    raise PipelineAborted(self.name)
+        self.put_stall += time.perf_counter() - start
+
+    def get(self):
+        depth = self._queue.qsize()
+        start = time.perf_counter()
+        while True:
+            try:
+                item = self._queue.get(timeout=0.1)
+                break
+            except queue.Empty:
+                if self.abort.is_set():
+                    raise PipelineAborted(self.name)
+        self.get_stall += time.perf_counter() - start
+        if item is not DONE:
+            self.items += 1
+            self.depth_sum += depth
+            self.depth_max = max(self.depth_max, depth)
+        return item
+
+    def wait(self, result):
+        """Block on an AsyncResult taken from this queue, counting the wait
+        as consumer stall since the item was not actually ready yet."""
+        start = time.perf_counter()
+        value = result.get()
+        self.get_stall += time.perf_counter() - start
+        return value
+
+
+class Stage(threading.Thread):
+    """Thread running one pipeline stage; a failure aborts the others."""
+
+    def __init__(self, name, target, abort, *args):
+        super().__init__(name=name, daemon=True)
+        self.target = target
+        self.args = args
+        self.abort = abort
+        self.error = None
+
+    def run(self):
+        try:
+            self.target(*self.args)
+        except PipelineAborted:
+            pass
+        except BaseException as e:
+            self.error = e
+            self.abort.set()
+
+
+def run_stages(stages):
+    """Start all stages, wait for them and re-raise the first failure."""
+    for stage in stages:
+        stage.start()
+    for stage in stages:
+        stage.join()
+    for stage in stages:
+        if stage.error is not None:
+            raise stage.error
+
+
+def format_report(queues, elapsed):
+    """Per-queue depth and stall times, one line per queue."""
+    lines = [
+        f"pipeline: {elapsed:.1f}s",
+        f"{'queue':10}{'items':>8}{'cap':>6}{'avg depth':>11}{'max':>6}"
+        f"{'put stall s':>13}{'get stall s':>13}",
+    ]
+    for q in queues:
+        avg = q.depth_sum / q.items if q.items else 0.0
+        lines.append(
+            f"{q.name:10}{q.items:8}{q.maxsize:6}{avg:11.1f}{q.depth_max:6}"
+            f"{q.put_stall:13.2f}{q.get_stall:13.2f}"
+        )
+    return "\n".join(lines)
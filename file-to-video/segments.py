@@ -0,0 +1,68 @@
+"""Multi-part videos: part naming, manifests and stream-copy concatenation."""
+
+import json
+import os
+
+import av
+
+
+def part_paths(dest, count):
+    """File names of the numbered parts of dest, e.g. out.part000.mp4."""
+    root, ext = os.path.splitext(dest)
+    return [f"{root}.part{i:03d}{ext}" for i in range(count)]
+
+
+def manifest_path(dest):
+    root, _ = os.path.splitext(dest)
+    return root + ".manifest.json"
+
+
+def write_manifest(dest, parts, frames):
+    """Describe a multi-part set: its parts in order and their frame counts."""
+    manifest = {
+        "Parts": [os.path.basename(part) for part in parts],
+        "Frames": frames,
+    }
+    with open(manifest_path(dest), "w") as f:
+        json.dump(manifest, f, indent=4)
+
+
+def read_manifest(path):
+    """Paths of the parts listed in a manifest, in order."""
+    with open(path) as f:
+        manifest = json.load(f)
+    folder = os.path.dirname(path)
+    return [os.path.join(folder, part) for part in manifest["Parts"]]
+
+
+def concat_parts(parts, dest):
+    """Join video parts into dest by copying their packets, no re-encode.
+
+    The parts must come from identically configured encoders. Each part's
+    timestamps are shifted to follow the previous part, keeping dts strictly
+    increasing across the joins.
+    """
+    output = av.open(dest, mode="w")
+    out_stream = None
+    end = 0
+    last_dts = None
+    for part in parts:
+        with av.open(part) as container:
+            in_stream = container.streams.video[0]
+            if out_stream is None:
+                out_stream = output.add_stream(template=in_stream)
+            offset = end
+            first = True
+            for packet in container.demux(in_stream):
+                if packet.dts is None:
+                    continue
+                if first and last_dts is not None:
+                    offset = max(offset, last_dts + 1 - packet.dts)
+                first = False
+                packet.pts += offset
+                packet.dts += offset
+                last_dts = packet.dts
+                end = max(end, packet.pts + packet.duration)
+                packet.stream = out_stream
+                output.mux(packet)
+    output.close()
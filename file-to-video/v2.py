@@ -1,6 +1,29 @@
+from functools import lru_cache
+
 import numpy as np
 from PIL import Image
 
+from common import default_resolution, global_gridSize
+
+# Calibration cells: the last row of every pilot_tile x pilot_tile tile of
+# the grid ends in a black and a white reference cell.
+pilot_tile = 18
+
+# Modulation: (bits per Y plane cell, whether the U and V planes carry a
+# bit per cell too). Chroma grids have half the cells each way, matching
+# yuv420p's subsampling.
+MODULATIONS = {
+    "binary": (1, False),
+    "gray4": (2, False),
+    "chroma": (1, True),
+    "gray4-chroma": (2, True),
+}
+
+# Luma level of each 2-bit symbol (first bit + 2 * second bit), Gray-coded
+# so that mistaking a level for its neighbour costs a single bit.
+GRAY_LEVELS = np.array([0, 85, 255, 170], dtype=np.uint8)
+GRAY_SYMBOLS = np.array([0, 1, 3, 2], dtype=np.uint8)
+
 
 def getBit(data, bit_index):
     """Retrieve the bit at the specified index from the data."""
@@ -16,43 +39,328 @@ def setBit(data, bit_index):
     data[byte_index] |= 1 << bit_position
 
 
-def create_custom_code(data, grid_size=256):
+def plane_shape(size):
+    """(rows, columns) of a grid, or (height, width) of a frame, given
+    either as a single side length or as (width, height)."""
+    if np.ndim(size) == 0:
+        return int(size), int(size)
+    width, height = size
+    return int(height), int(width)
+
+
+def default_grid(resolution):
+    """Grid filling resolution with cells of the default size, i.e.
+    global_gridSize cells across default_resolution pixels."""
+    height, width = plane_shape(resolution)
+    rows = height * global_gridSize // default_resolution
+    cols = width * global_gridSize // default_resolution
+    return rows if rows == cols else (cols, rows)
+
+
+@lru_cache(maxsize=8)
+def pilot_cells(grid_size):
+    """Flat indices of the black and the white calibration cells, each as a
+    (tile rows, tile columns) array, tiles covering the grid with partial
+    ones dropped."""
+    rows, cols = plane_shape(grid_size)
+    row = np.arange(rows // pilot_tile) * pilot_tile + pilot_tile - 1
+    col = np.arange(cols // pilot_tile) * pilot_tile + pilot_tile - 2
+    black = row[:, None] * cols + col[None, :]
+    return black, black + 1
+
+
+@lru_cache(maxsize=8)
+def block_order(shape, block):
+    """Flat indices of the cells of a grid of shape (rows, columns), taken
+    block x block tile by tile, tiles and the cells within them each in
+    raster order. Tiles at the right and bottom edges may be partial."""
+    rows, cols = shape
+    row, col = np.divmod(np.arange(rows * cols), cols)
+    return np.lexsort((col % block, row % block, col // block, row // block))
+
+
+@lru_cache(maxsize=8)
+def data_cells(grid_size, calibrated, block=1):
+    """Flat indices of the cells carrying data, in the order bits fill
+    them: raster order, or with block > 1 tile by tile (see block_order)."""
+    rows, cols = plane_shape(grid_size)
+    if block > 1:
+        cells = block_order((rows, cols), block)
+    else:
+        cells = np.arange(rows * cols)
+    if not calibrated:
+        return cells
+    black, white = pilot_cells(grid_size)
+    return cells[~np.isin(cells, np.concatenate([black.ravel(), white.ravel()]))]
+
+
+def chroma_shape(grid_size):
+    """(rows, columns) of the U and V grids."""
+    rows, cols = plane_shape(grid_size)
+    return rows // 2, cols // 2
+
+
+@lru_cache(maxsize=8)
+def chroma_cells(grid_size, block=1):
+    """data_cells for the U and V grids, whose macroblocks are half as many
+    cells across."""
+    return block_order(chroma_shape(grid_size), max(1, block // 2))
+
+
+def frame_bits(grid_size, calibrated=False, modulation="binary"):
+    """Bits a frame of the grid holds."""
+    luma_bits, chroma = MODULATIONS[modulation]
+    bits = data_cells(grid_size, calibrated).size * luma_bits
+    if chroma:
+        rows, cols = chroma_shape(grid_size)
+        bits += 2 * rows * cols
+    return bits
+
+
+def frame_capacity(grid_size, calibrated=False, modulation="binary"):
+    """Bytes a frame of the grid holds."""
+    return frame_bits(grid_size, calibrated, modulation) // 8
+
+
+def modulate(data, grid_size=256, calibrated=False, modulation="binary", block=1):
+    """Cell levels encoding data: the Y plane grid and, with a chroma
+    modulation, the U and V plane grids.
+
+    Bits fill the Y plane's data cells in raster order, a cell at a time,
+    then the U grid and the V grid. With block > 1 each plane is filled
+    tile by tile instead, block x block Y cells to a tile, so that a tile
+    the size of an H.264 macroblock holds consecutive bytes.
+    """
+    # bitorder="little" keeps bit k of byte n at cell 8 * n + k, the same
+    # raster order the getBit loop used, so old videos stay decodable.
+    luma_bits, chroma = MODULATIONS[modulation]
+    buf = np.frombuffer(data, dtype=np.uint8)
+    cells = data_cells(grid_size, calibrated, block)
+    count = frame_bits(grid_size, calibrated, modulation)
+    bits = np.unpackbits(buf, count=count, bitorder="little")
+    luma = cells.size * luma_bits
+    if luma_bits == 2:
+        levels = GRAY_LEVELS[bits[0:luma:2] + 2 * bits[1:luma:2]]
+    else:
+        levels = bits[:luma]
+        np.multiply(levels, 255, out=levels)
+    shape = plane_shape(grid_size)
+    if calibrated or block > 1:
+        grid = np.zeros(shape[0] * shape[1], dtype=np.uint8)
+        grid[cells] = levels
+        if calibrated:
+            grid[pilot_cells(grid_size)[1]] = 255
+        levels = grid
+    planes = [levels.reshape(shape)]
+    if chroma:
+        uv = bits[luma:] * np.uint8(255)
+        uv = uv.reshape(2, -1)
+        if block > 1:
+            uv[:, chroma_cells(grid_size, block)] = uv.copy()
+        planes.extend(uv.reshape(2, *chroma_shape(grid_size)))
+    return planes
+
+
+def create_custom_code(data, grid_size=256, calibrated=False):
     """Create a custom encoded image from data."""
-    grid = np.zeros((grid_size, grid_size), dtype=np.uint8)
-    bit_length = len(data) * 8
-    bit_index = 0
-    for i in range(grid_size):
-        for j in range(grid_size):
-            if bit_index >= bit_length:
-                return grid
-            if getBit(data, bit_index):
-                grid[i, j] = 255
-            bit_index += 1
-    return grid
+    return modulate(data, grid_size, calibrated)[0]
 
 
 def encode_to_image(data, grid_size=256, resolution=1080):
     """Encode data into a binary grid and save as an image."""
     grid = create_custom_code(data, grid_size)
-    print(grid)
     img = Image.fromarray(np.stack([grid] * 3, axis=-1), "RGB")
-    return np.array(img.resize((resolution, resolution), Image.Resampling.NEAREST))
+    height, width = plane_shape(resolution)
+    return np.array(img.resize((width, height), Image.Resampling.NEAREST))
+
+
+def new_yuv420_frame(width, height):
+    """Allocate a yuv420p frame buffer (Y plane followed by U and V) with
+    neutral chroma, laid out the way av.VideoFrame.from_ndarray expects."""
+    frame = np.empty((height * 3 // 2, width), dtype=np.uint8)
+    frame[height:] = 128
+    return frame
+
+
+def upscale_into(grid, out):
+    """Nearest-neighbour upscale of grid into the preallocated 2D array out."""
+    rows, cols = grid.shape
+    height, width = out.shape
+    if height % rows == 0 and width % cols == 0:
+        # Integer scale: broadcast each cell over its block, no temporaries.
+        blocks = out.reshape(rows, height // rows, cols, width // cols)
+        blocks[...] = grid[:, None, :, None]
+    else:
+        # Same pixel centres PIL's NEAREST resize picks.
+        y = (np.arange(height) * 2 + 1) * rows // (height * 2)
+        x = (np.arange(width) * 2 + 1) * cols // (width * 2)
+        np.take(grid[y], x, axis=1, out=out)
+    return out
+
+
+def encode_to_luma(
+    data,
+    grid_size=256,
+    resolution=1080,
+    out=None,
+    calibrated=False,
+    modulation="binary",
+    block=1,
+):
+    """Encode data straight into the Y plane of a yuv420p frame buffer.
+
+    grid_size and resolution are side lengths or (width, height). Skips the
+    RGB stack, the PIL round trip and the encoder's rgb24 to yuv420p
+    conversion. Pass a buffer from new_yuv420_frame as out to reuse
+    it between frames; its U and V planes are left untouched unless the
+    modulation uses them.
+    """
+    height, width = plane_shape(resolution)
+    if out is None:
+        out = new_yuv420_frame(width, height)
+    planes = modulate(data, grid_size, calibrated, modulation, block)
+    upscale_into(planes[0], out[:height])
+    if len(planes) > 1:
+        uv = out[height:].reshape(2, height // 2, width // 2)
+        upscale_into(planes[1], uv[0])
+        upscale_into(planes[2], uv[1])
+    return out
+
+
+def yuv420_planes(frame):
+    """Y, U and V planes of a yuv420p frame array."""
+    height = frame.shape[0] * 2 // 3
+    width = frame.shape[1]
+    uv = frame[height:].reshape(2, height // 2, width // 2)
+    return frame[:height], uv[0], uv[1]
+
+
+def centre_lines(length, cells):
+    """Indices of the central pixels of each of cells equal spans of a line
+    of length pixels, span by span, and how many each span contributes."""
+    size = length / cells
+    count = max(1, int(size) // 2)
+    starts = np.floor((np.arange(cells) + 0.5) * size - count / 2)
+    lines = starts.astype(np.intp)[:, None] + np.arange(count)
+    return np.clip(lines, 0, length - 1).reshape(-1), count
+
+
+@lru_cache(maxsize=8)
+def centre_pixels(shape, grid_size):
+    """Row indices of the central pixels of the cells of the grid stretched
+    over an image of shape (height, width) and how many rows each cell
+    gets, then the same for columns.
+
+    Each cell contributes the middle half of its pixels each way, at least
+    one, leaving out the edges where the codec's ringing and blocking sit.
+    """
+    rows, cols = plane_shape(grid_size)
+    return centre_lines(shape[0], rows) + centre_lines(shape[1], cols)
+
+
+def sample_cells(img, grid_size=256):
+    """Average luminance of the central pixels of every cell of the grid,
+    row by row.
+
+    The grid is stretched over the whole image, whatever its aspect ratio.
+    """
+    if img.ndim == 3:
+        img = np.asarray(Image.fromarray(img).convert("L"))
+    y, height, x, width = centre_pixels(img.shape, grid_size)
+    # Whole rows first, then columns: two cheap gathers, and the sums run
+    # over strided views rather than small reduction axes.
+    pixels = img[y][:, x]
+    lines = pixels[::height].astype(np.uint32)
+    for i in range(1, height):
+        lines += pixels[i::height]
+    cells = lines[:, ::width].copy()
+    for i in range(1, width):
+        cells += lines[:, i::width]
+    return (cells * np.float32(1 / (height * width))).reshape(-1)
 
 
 def decode_from_image(img, grid_size=256):
     """Decode binary data from an image file."""
-    img = Image.fromarray(img)
-    img = img.convert("L")
-    img = img.resize((grid_size, grid_size), Image.Resampling.BOX)
+    bits = sample_cells(img, grid_size) > 128
+    return bytearray(np.packbits(bits, bitorder="little")[: bits.size // 8])
+
+
+def smooth_tiles(levels):
+    """Mean of every tile's level and its neighbours'."""
+    padded = np.pad(levels, 1, mode="edge")
+    rows, cols = levels.shape
+    total = sum(
+        padded[y : y + rows, x : x + cols] for y in range(3) for x in range(3)
+    )
+    return total / 9
+
+
+def cell_levels(cells, grid_size):
+    """Black and white level for every cell from the calibration cells of
+    the frame.
+
+    Each tile's levels are averaged with the neighbouring tiles', as
+    lighting changes slowly while a single reference cell is easily blurred
+    or damaged. Cells outside whole tiles take the nearest tile's.
+    """
+    black, white = pilot_cells(grid_size)
+    rows, cols = plane_shape(grid_size)
+    row = np.minimum(np.arange(rows) // pilot_tile, black.shape[0] - 1)
+    col = np.minimum(np.arange(cols) // pilot_tile, black.shape[1] - 1)
+    return [
+        smooth_tiles(cells[pilots])[row][:, col].reshape(-1)
+        for pilots in (black, white)
+    ]
+
+
+def demodulate_luma(cells, low, high, luma_bits):
+    """Bits of the Y plane cells between black level low and white level
+    high, and every bit's margin: how far its cell was from the nearest
+    threshold between levels."""
+    if luma_bits == 1:
+        distance = cells - (low + high) / 2
+        return distance > 0, np.abs(distance)
+    top = (1 << luma_bits) - 1
+    step = np.maximum(high - low, 1) / top
+    position = (cells - low) / step
+    level = np.clip(np.rint(position), 0, top)
+    below = np.where(level > 0, position - level + 0.5, np.inf)
+    above = np.where(level < top, level + 0.5 - position, np.inf)
+    margins = np.minimum(below, above) * step
+    symbols = GRAY_SYMBOLS[level.astype(np.uint8)]
+    bits = np.stack([symbols & 1, symbols >> 1], axis=1).reshape(-1)
+    return bits, np.repeat(margins, 2)
 
-    grid = np.array(img)
-    data = bytearray(grid_size * grid_size // 8)
 
-    bit_index = 0
-    for i in range(grid_size):
-        for j in range(grid_size):
-            if grid[i, j] > 128:
-                setBit(data, bit_index)
-            bit_index += 1
+def decode_with_margins(
+    img, grid_size=256, calibrated=False, modulation="binary", block=1
+):
+    """decode_from_image plus the margin of every byte: how far the cell of
+    its eight closest to the threshold was from it, 0 being a coin toss.
 
-    return data
+    A calibrated frame is thresholded against its calibration cells rather
+    than at 128, so shifts in brightness or contrast cost no bit errors.
+    A chroma modulation takes the frame as a yuv420p array. block is the
+    layout modulate was given.
+    """
+    luma_bits, chroma = MODULATIONS[modulation]
+    if chroma:
+        img, u, v = yuv420_planes(img)
+    cells = sample_cells(img, grid_size)
+    used = data_cells(grid_size, calibrated, block)
+    # Without calibration cells the binary threshold stays at exactly 128.
+    low, high = 1.0, 255.0
+    if calibrated:
+        low, high = (levels[used] for levels in cell_levels(cells, grid_size))
+    bits, margins = demodulate_luma(cells[used], low, high, luma_bits)
+    if chroma:
+        shape = chroma_shape(grid_size)[::-1]
+        order = chroma_cells(grid_size, block)
+        uv = np.concatenate([sample_cells(plane, shape)[order] for plane in (u, v)])
+        uv = uv - 128
+        bits = np.concatenate([bits, uv > 0])
+        margins = np.concatenate([margins, np.abs(uv)])
+    count = bits.size // 8
+    data = bytearray(np.packbits(bits, bitorder="little")[:count])
+    margins = margins[: count * 8].reshape(count, 8).min(axis=1)
+    return data, np.minimum(margins, 255).astype(np.uint8)
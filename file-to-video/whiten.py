@@ -0,0 +1,35 @@
+"""Whitening: XOR each frame's bytes with a keyed pseudo-random mask.
+
+Structured payloads, runs of zeros or repeated headers, rasterize into flat
+areas and regular patterns that libx264 quantizes very differently from
+noise, so error rates swing from frame to frame. XORing every frame's
+bytes, padding included, with the same noise-like mask after RS encoding
+makes every frame look like noise to the codec. The mask is the SHAKE-256
+output for the key, so it is the same on every platform and NumPy version,
+and XORing again undoes it.
+"""
+
+import hashlib
+from functools import lru_cache
+
+import numpy as np
+
+default_key = 0
+
+
+@lru_cache(maxsize=8)
+def whitening_mask(key, length):
+    """The first length bytes of the mask for key, read-only."""
+    seed = b"file2video whitening" + key.to_bytes(8, "big", signed=True)
+    return np.frombuffer(hashlib.shake_256(seed).digest(length), dtype=np.uint8)
+
+
+def whiten(data, key, length=None):
+    """data XORed with the mask, zero-padded to length bytes first if given.
+
+    Its own inverse: whiten(whiten(data, key), key) == data.
+    """
+    buf = np.zeros(max(len(data), length or 0), dtype=np.uint8)
+    buf[: len(data)] = np.frombuffer(data, dtype=np.uint8)
+    np.bitwise_xor(buf, whitening_mask(key, len(buf)), out=buf)
+    return bytearray(buf)